@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# Synthetic load orders and benchmarks for omw_shuffle_ingredients.
+#
+# This doesn't need a game install: it writes made-up plugins full
+# of INGR, LEVC and filler (CELL/DIAL/INFO-sized) records, plus an
+# openmw.cfg that loads them, and then times each stage of the
+# read/parse/shuffle/pack pipeline against them.
+#
+#   ./bench_shuffle_ingredients.py generate some/dir --plugins 5
+#   ./bench_shuffle_ingredients.py run --scales 1,4,16
+#   ./bench_shuffle_ingredients.py check
+
+from random import Random
+import argparse
+import os.path
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import omw_shuffle_ingredients as shuf
+
+
+# a little under what you'd find in Morrowind.esm, for one
+# "scale" worth of a plugin
+defaultCounts = { 'ingredients': 150,
+                  'levcs': 60,
+                  'fillers': 2000 }
+
+# (record type, number of subrecords, bytes per subrecord)
+# for the records we don't care about, roughly sized like
+# the real things
+fillerShapes = [ ('CELL', 24, 48),
+                 ('DIAL', 2, 16),
+                 ('INFO', 8, 64),
+                 ('LAND', 6, 1024) ]
+
+
+def packRecord(rectype, body):
+    return shuf.packString(rectype) + shuf.packLong(len(body)) + \
+        bytes(8) + body
+
+def packRawSubRecord(lbl, data):
+    return shuf.packString(lbl) + shuf.packLong(len(data)) + data
+
+def packLEVC(name, items):
+    body = [ shuf.packStringSubRecord('NAME', name),
+             shuf.packIntSubRecord('DATA', 0),
+             shuf.packIntSubRecord('NNAM', 0, 1),
+             shuf.packIntSubRecord('INDX', len(items)) ]
+    for item in items:
+        body.append(shuf.packStringSubRecord('CNAM', item))
+        body.append(shuf.packIntSubRecord('INTV', 1, 2))
+    return packRecord('LEVC', b''.join(body))
+
+def packFiller(n, rng):
+    (rectype, nsubs, sublen) = fillerShapes[n % len(fillerShapes)]
+    body = [ shuf.packStringSubRecord('NAME', '%s_%d' % (rectype.lower(), n)) ]
+    for i in range(nsubs):
+        body.append(packRawSubRecord('DATA', bytes(rng.randrange(1, sublen + 1))))
+    return packRecord(rectype, b''.join(body))
+
+def randomIngredient(ident, plugin, rng):
+    ingr = shuf.Ingredient()
+    ingr.id = ident
+    ingr.name = ident.replace('_', ' ').title()
+    ingr.model = 'n\\%s.nif' % ident
+    ingr.icon = 'n\\%s.dds' % ident
+    ingr.weight = 0.5
+    ingr.value = rng.randrange(1, 100)
+    if rng.random() < 0.1:
+        ingr.script = 'script_%s' % ident
+    ingr.file = plugin
+
+    effects = []
+    for i in range(4):
+        if i < rng.randrange(1, 5):
+            effect = rng.randrange(1, 137)
+            effects.append(shuf.normalizeEffect(effect, rng.randrange(27),
+                                                rng.randrange(8)))
+        else:
+            effects.append((-1, -1, -1))
+    ingr.effects = effects
+    return ingr
+
+def generatePlugin(filename, masters, ingredients, levcs, fillers, rng):
+    # write one synthetic plugin. ingredient ids are only unique
+    # within the plugin's own prefix; a few of them are shared
+    # with the masters, so later plugins override earlier ones
+    plugin = os.path.basename(filename)
+    prefix = os.path.splitext(plugin)[0].lower()
+
+    ids = [ 'ingred_%s_%d' % (prefix, i) for i in range(ingredients) ]
+    if masters:
+        mprefix = os.path.splitext(masters[0][0])[0].lower()
+        for i in range(0, ingredients, 10):
+            ids[i] = 'ingred_%s_%d' % (mprefix, i)
+
+    records = []
+    for ident in ids:
+        if 'food' not in ident and rng.random() < 0.2:
+            ident = ident.replace('ingred_', 'food_')
+        records.append(shuf.packINGR(randomIngredient(ident, plugin, rng)))
+    for i in range(levcs):
+        name = ('food_list_%s_%d' if i % 3 == 0 else 'lev_%s_%d') % (prefix, i)
+        records.append(packLEVC(name, rng.sample(ids, min(5, len(ids)))))
+    for i in range(fillers):
+        records.append(packFiller(i, rng))
+
+    rng.shuffle(records)
+
+    with open(filename, 'wb') as f:
+        f.write(shuf.packTES3('synthetic plugin', len(records), masters))
+        for r in records:
+            f.write(r)
+
+def generateLoadOrder(outdir, plugins=3, scale=1, seed=0):
+    # write `plugins` synthetic plugins (the first one a master)
+    # under outdir/data, with an openmw.cfg pointing at them.
+    # returns the path to the openmw.cfg
+    rng = Random(seed)
+    datadir = os.path.join(outdir, 'data')
+    os.makedirs(datadir, exist_ok=True)
+
+    names = [ 'Synthetic.esm' ] + [ 'Synthetic%d.esp' % i for i in range(1, plugins) ]
+    masters = []
+    for name in names:
+        fullpath = os.path.join(datadir, name)
+        generatePlugin(fullpath, masters,
+                       defaultCounts['ingredients'] * scale,
+                       defaultCounts['levcs'] * scale,
+                       defaultCounts['fillers'] * scale, rng)
+        if not masters:
+            masters = [ (name, os.path.getsize(fullpath)) ]
+
+    cfg = os.path.join(outdir, shuf.configFilename)
+    with open(cfg, 'w') as f:
+        # relative data= paths are taken relative to the cfg's
+        # own directory, so write it out in full
+        f.write('data="%s"\n' % os.path.abspath(datadir))
+        for name in names:
+            f.write('content=%s\n' % name)
+    return cfg
+
+
+def measure(fn, trace_memory):
+    # run fn once for timing, and (optionally) once more under
+    # tracemalloc for its peak memory, since tracing slows
+    # things down too much to time at the same time
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return (result, elapsed, peak)
+
+def benchLoadOrder(cfg, outdir, trace_memory=True):
+    # time each stage against one generated load order.
+    # returns a list of (stage, seconds, bytes, records, peak)
+    fp_mods = shuf.readCfg(cfg)
+    nbytes = sum(os.path.getsize(f) for f in fp_mods)
+    results = []
+
+    def readAll():
+        return sum(1 for f in fp_mods for r in shuf.readRecords(f))
+    (nrecs, t, peak) = measure(readAll, trace_memory)
+    results.append(('readRecords', t, nbytes, nrecs, peak))
+
+    def getAll():
+        return [ shuf.getRecords(f, ('TES3', 'LEVC', 'INGR')) for f in fp_mods ]
+    (raw, t, peak) = measure(getAll, trace_memory)
+    results.append(('getRecords', t, nbytes, nrecs, peak))
+
+    ringr = [ r for per_file in raw for r in per_file[2] ]
+    ingrbytes = sum(r.length + 16 for r in ringr)
+    (ingrs, t, peak) = measure(lambda: shuf.parseINGRs(ringr), trace_memory)
+    results.append(('parseINGR', t, ingrbytes, len(ringr), peak))
+
+    plugins = [ shuf.parsePlugin(f) for f in fp_mods ]
+
+    def shuffleAll():
+        collected = shuf.collectIngredients(plugins)
+        return shuf.shuffleCollected(collected, Random(0))
+    (shuffled, t, peak) = measure(shuffleAll, trace_memory)
+    results.append(('shuffle', t, None, len(shuffled), peak))
+
+    ingredients = list(shuffled.values())
+    outmod = os.path.join(outdir, 'bench.omwaddon')
+    def packAll():
+        shuf.writeAddon(outmod, 'benchmark', [], ingredients)
+    (_, t, peak) = measure(packAll, trace_memory)
+    results.append(('packINGR', t, os.path.getsize(outmod), len(ingredients), peak))
+
+    return results
+
+def checkConstrained(cfg, maxshares=(2, 3, 6), seeds=range(5)):
+    # check the constrained shuffle against one generated load
+    # order: no ingredient that had effects ends up without
+    # any, and where there are enough effects to go around,
+    # none is on more than maxshare ingredients. returns a list
+    # of what went wrong
+    plugins = [ shuf.parsePlugin(f) for f in shuf.readCfg(cfg) ]
+    collected = shuf.collectIngredients(plugins)
+    problems = []
+
+    for kind in ('foods', 'nonfoods'):
+        pool = collected[kind]
+        withEffects = [ i for i in pool.values() if i.effects[0][0] >= 0 ]
+        distinct = len(set(e for i in pool.values() for e in i.effects if e[0] >= 0))
+
+        for maxshare in maxshares:
+            for seed in seeds:
+                copies = { k: v.copy() for (k, v) in pool.items() }
+                out = shuf.shuffle_ingredients_constrained(copies, Random(seed), maxshare)
+
+                counts = {}
+                empty = 0
+                for ingr in out.values():
+                    effs = [ e for e in ingr.effects if e[0] >= 0 ]
+                    if not effs:
+                        empty += 1
+                    for e in effs:
+                        counts[e] = counts.get(e, 0) + 1
+
+                where = "%s, maxshare %d, seed %d" % (kind, maxshare, seed)
+                if empty > len(pool) - len(withEffects):
+                    problems.append("%s: %d ingredients lost all their effects"
+                                    % (where, empty - (len(pool) - len(withEffects))))
+                if distinct * maxshare >= len(withEffects) and counts \
+                   and max(counts.values()) > maxshare:
+                    problems.append("%s: an effect is on %d ingredients"
+                                    % (where, max(counts.values())))
+    return problems
+
+def printResults(scale, results):
+    print("scale %d" % scale)
+    print("  %-12s%10s%12s%14s%12s" % ("stage", "seconds", "MB/s", "records/s", "peak MB"))
+    for (stage, t, nbytes, nrecs, peak) in results:
+        t = max(t, 1e-9)
+        mbs = "%.1f" % (nbytes / t / 1e6) if nbytes is not None else '-'
+        peakmb = "%.1f" % (peak / 1e6) if peak is not None else '-'
+        print("  %-12s%10.3f%12s%14.0f%12s" % (stage, t, mbs, nrecs / t, peakmb))
+    print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest = 'command')
+
+    gen = subparsers.add_parser('generate',
+                                help = 'Write a synthetic load order and openmw.cfg into a directory.')
+    gen.add_argument('outdir', type = str,
+                     help = 'Directory to write the load order into.')
+
+    run = subparsers.add_parser('run',
+                                help = 'Generate load orders at several scales, and time each stage against them.')
+    run.add_argument('--scales', type = str, default = '1,4,16',
+                     help = 'Comma-separated list of scales to run at. Scale 1 is roughly one Morrowind.esm worth of ingredients per plugin.')
+    run.add_argument('--workdir', type = str, default = None,
+                     help = 'Directory to generate load orders in. By default, a temporary directory that gets removed afterwards.')
+    run.add_argument('--nomemory', default = False, action = 'store_true',
+                     help = 'Skip measuring peak memory, which roughly halves the run time.')
+
+    check = subparsers.add_parser('check',
+                                  help = 'Generate a load order, and check that the constrained shuffle keeps to --maxshare wherever it can.')
+
+    for sp in (gen, run, check):
+        sp.add_argument('--plugins', type = int, default = 3,
+                        help = 'Number of plugins in the load order (the first is a master).')
+        sp.add_argument('--seed', type = int, default = 0,
+                        help = 'Seed for the generated data.')
+
+    gen.add_argument('--scale', type = int, default = 1,
+                     help = 'Multiplier for the number of ingredients, leveled lists and filler records per plugin.')
+
+    p = parser.parse_args()
+
+    if p.command == 'generate':
+        cfg = generateLoadOrder(p.outdir, p.plugins, p.scale, p.seed)
+        print("Wrote '%s'" % cfg)
+    elif p.command == 'run':
+        scales = [ int(x) for x in p.scales.split(',') ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            workdir = p.workdir or tmpdir
+            for scale in scales:
+                outdir = os.path.join(workdir, 'scale%d' % scale)
+                cfg = generateLoadOrder(outdir, p.plugins, scale, p.seed)
+                printResults(scale, benchLoadOrder(cfg, outdir, not p.nomemory))
+    elif p.command == 'check':
+        with tempfile.TemporaryDirectory() as workdir:
+            cfg = generateLoadOrder(workdir, p.plugins, 1, p.seed)
+            problems = checkConstrained(cfg)
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print("OK")
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -1,13 +1,43 @@
 #!/usr/bin/env python3
 
-from struct import pack, unpack
+from struct import pack, unpack, Struct
+from array import array
 from datetime import date
 from pathlib import Path
-from random import shuffle
+from random import Random, SystemRandom
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat, chain
+from contextlib import contextmanager, redirect_stdout
 import os.path
 import argparse
+import mmap
+import hashlib
+import pickle
 import sys
 import re
+import csv
+import fnmatch
+import time
+import json
+import tracemalloc
+import threading
+import io
+from sys import intern
+
+try:
+    import resource
+except ImportError:
+    # not available on windows. we just won't report RSS there
+    resource = None
+
+try:
+    import numpy
+except ImportError:
+    # optional. with it, the dedup runs on columns of codes
+    # (see findDupesColumnar), and the 'columnar' shuffle is
+    # available; without it, the pure python versions do the
+    # same jobs
+    numpy = None
 
 
 configFilename = 'openmw.cfg'
@@ -18,6 +48,59 @@ configPaths = { 'linux':   '~/.config/openmw',
 modPaths = { 'linux':   '~/.local/share/openmw/data',
              'freebsd': '~/.local/share/openmw/data',
              'darwin':  '~/Library/Application Support/openmw/data' }
+
+# what the ?userdata? and ?global? tokens in openmw.cfg stand
+# for. ?userconfig? is configPaths, and ?local? is taken to be
+# the directory of the first config file (it's really where the
+# openmw binary lives, and that's usually where its config is)
+userDataPaths = { 'linux':   '~/.local/share/openmw',
+                  'freebsd': '~/.local/share/openmw',
+                  'darwin':  '~/Library/Application Support/openmw' }
+
+globalDataPaths = { 'linux':   '/usr/share/games/openmw',
+                    'freebsd': '/usr/local/share/games/openmw',
+                    'darwin':  '/Library/Application Support/openmw' }
+
+cachePaths = { 'linux':   '~/.cache/omw_shuffle_ingredients',
+               'freebsd': '~/.cache/omw_shuffle_ingredients',
+               'darwin':  '~/Library/Caches/omw_shuffle_ingredients' }
+
+# bump this whenever the shape of the parsed data changes, so
+# stale cache entries get thrown out instead of misread
+cacheVersion = 6
+
+# same idea, for the run manifest written next to the output
+manifestVersion = 4
+
+# and for the shuffle itself: bump this whenever the same
+# ingredients and seed would shuffle differently, so outputs
+# from older versions aren't mistaken for up to date (see
+# inputHash)
+shuffleVersion = 1
+
+# precompiled layouts for the fixed-size parts of records:
+#   - the 16-byte record header (type, length, flags)
+#   - the 8-byte subrecord header (type, length)
+#   - the 300-byte HEDR in TES3 (version, filetype, author,
+#     description, number of records)
+#   - the 56-byte IRDT in INGR (weight, value, then four
+#     each of effect ids, skill ids, and attribute ids)
+recordHeaderStruct = Struct('<4sL8x')
+subRecordHeaderStruct = Struct('<4sL')
+hedrStruct = Struct('<fl32s256sl')
+irdtFormat = 'fl4l4l4l'
+irdtStruct = Struct('<' + irdtFormat)
+irdtSubRecordStruct = Struct('<4sL' + irdtFormat)
+
+# even when effects don't use them, ingredients store a skill
+# and attribute. in order to be better about duplicate items,
+# we want to normalize that dead data, so we need to know which
+# effects actually use each
+#
+# effect id referenced from openmw itself:
+# openmw/apps/openmw/mwgui/widgets.hpp
+attributeEffects = frozenset((17, 22, 74, 79, 85))
+skillEffects = frozenset((21, 26, 78, 83, 89))
              
 
 def packLong(i):
@@ -39,7 +122,14 @@ def packPaddedString(s, l):
         return bs + bytes(l - len(bs))
 
 def parseString(ba):
+    # subrecord data may be a memoryview into a mapped file, so
+    # materialize it here (a no-op when it's already bytes)
+    ba = bytes(ba)
     i = ba.find(0)
+    if i < 0:
+        # not every string is null-terminated (descriptions,
+        # mostly), in which case it's the whole thing
+        i = len(ba)
     return ba[:i].decode(encoding='ascii', errors='ignore')
 
 def parseNum(ba):
@@ -48,157 +138,931 @@ def parseNum(ba):
 def parseFloat(ba):
     return unpack('f', ba)[0]
 
+# The layouts of the subrecords we know how to decode, by record
+# type. each subrecord is either 'string' (text, null-terminated
+# or not), or a Struct with a name for each of its fields.
+# subrecords not listed here are skipped when decoding.
+#
+# references:
+#   http://www.mwmythicmods.com/argent/tech/tute.html
+#   http://www.mwmythicmods.com/tutorials/MorrowindESPFormat.html
+
+leveledSchema = { 'NAME': 'string',
+                  'DATA': (Struct('<l'), ('flags',)),
+                  'NNAM': (Struct('<B'), ('chance',)),
+                  'INDX': (Struct('<l'), ('count',)),
+                  'CNAM': 'string',
+                  'INAM': 'string',
+                  'INTV': (Struct('<h'), ('level',)) }
+
+recordSchemas = {
+    'TES3': { 'HEDR': (hedrStruct, ('version', 'filetype', 'author',
+                                    'desc', 'numrecords')),
+              'MAST': 'string',
+              'DATA': (Struct('<q'), ('size',)) },
+
+    'INGR': { 'NAME': 'string',
+              'MODL': 'string',
+              'FNAM': 'string',
+              'ITEX': 'string',
+              'SCRI': 'string',
+              'IRDT': (irdtStruct, ('weight', 'value',
+                                    'effect1', 'effect2', 'effect3', 'effect4',
+                                    'skill1', 'skill2', 'skill3', 'skill4',
+                                    'attribute1', 'attribute2', 'attribute3',
+                                    'attribute4')) },
+
+    'ALCH': { 'NAME': 'string',
+              'MODL': 'string',
+              'TEXT': 'string',
+              'SCRI': 'string',
+              'FNAM': 'string',
+              'ALDT': (Struct('<fll'), ('weight', 'value', 'autocalc')),
+              'ENAM': (Struct('<hbblllll'), ('effect', 'skill', 'attribute',
+                                             'range', 'area', 'duration',
+                                             'magmin', 'magmax')) },
+
+    'MGEF': { 'INDX': (Struct('<l'), ('index',)),
+              'MEDT': (Struct('<lfllllfff'), ('school', 'basecost', 'flags',
+                                              'red', 'green', 'blue',
+                                              'speed', 'size', 'sizecap')),
+              'ITEX': 'string',
+              'PTEX': 'string',
+              'CVFX': 'string',
+              'BVFX': 'string',
+              'HVFX': 'string',
+              'AVFX': 'string',
+              'CSND': 'string',
+              'BSND': 'string',
+              'HSND': 'string',
+              'ASND': 'string',
+              'DESC': 'string' },
+
+    'LEVC': leveledSchema,
+    'LEVI': leveledSchema,
+}
+
+def makeDecoder(layout):
+    # turn one subrecord layout into a function from the raw
+    # data to its value: a str, a single number, or a dict of
+    # named fields. data too short for the layout gives None
+    if layout == 'string':
+        return parseString
+
+    (st, names) = layout
+    size = st.size
+    unpack_from = st.unpack_from
+
+    if len(names) == 1:
+        def decode(data):
+            if len(data) < size:
+                return None
+            return unpack_from(data)[0]
+    else:
+        def decode(data):
+            if len(data) < size:
+                return None
+            return dict(zip(names, unpack_from(data)))
+    return decode
+
+# built once, here, from the schemas above
+subRecordDecoders = { rectype: { subtype: makeDecoder(layout)
+                                 for (subtype, layout) in schema.items() }
+                      for (rectype, schema) in recordSchemas.items() }
+
+def decodeRecord(rec, subtypes=None):
+    # decode a record's subrecords with its schema, in order, as
+    # a list of (subrecord type, value) pairs. subrecords the
+    # schema doesn't know (or that are too short) are left out.
+    # subtypes, if given, limits it to those subrecord types
+    decoders = subRecordDecoders.get(rec.type, {})
+    decoded = []
+    for sr in rec.iterSubs():
+        if subtypes is not None and sr['type'] not in subtypes:
+            continue
+        decode = decoders.get(sr['type'])
+        if decode is None:
+            continue
+        value = decode(sr['data'])
+        if value is not None:
+            decoded.append((sr['type'], value))
+    return decoded
+
 def parseTES3(rec):
     tesrec = {}
-    sr = rec['subrecords']
-    tesrec['version'] = parseFloat(sr[0]['data'][0:4])
-    tesrec['filetype'] = parseNum(sr[0]['data'][4:8])
-    tesrec['author'] = parseString(sr[0]['data'][8:40])
-    tesrec['desc'] = parseString(sr[0]['data'][40:296])
-    tesrec['numrecords'] = parseNum(sr[0]['data'][296:300])
-
     masters = []
-    for i in range(1, len(sr), 2):
-        mastfile = parseString(sr[i]['data'])
-        mastsize = parseNum(sr[i+1]['data'])
-        masters.append((mastfile, mastsize))
 
-    tesrec['masters'] = masters
+    for (subtype, value) in decodeRecord(rec):
+        if subtype == 'HEDR':
+            tesrec.update(value)
+            tesrec['author'] = parseString(value['author'])
+            tesrec['desc'] = parseString(value['desc'])
+        elif subtype == 'MAST':
+            masters.append([ value, 0 ])
+        elif subtype == 'DATA' and masters:
+            masters[-1][1] = value
+
+    tesrec['masters'] = [ tuple(m) for m in masters ]
     return tesrec
 
-def parseINGR(rec):
-    ingrrec = {}
-    srs = rec['subrecords']
-
-    for sr in srs:
-        if sr['type'] == 'NAME':
-            ingrrec['id'] = parseString(sr['data'])
-        elif sr['type'] == 'MODL':
-            ingrrec['model'] = parseString(sr['data'])
-        elif sr['type'] == 'FNAM':
-            ingrrec['name'] = parseString(sr['data'])
-        elif sr['type'] == 'ITEX':
-            ingrrec['icon'] = parseString(sr['data'])
-        elif sr['type'] == 'SCRI':
-            ingrrec['script'] = parseString(sr['data'])
-        elif sr['type'] == 'IRDT':
-            attr_struct = sr['data']
-            ingrrec['weight'] = parseFloat(attr_struct[0:4])
-            ingrrec['value'] = parseNum(attr_struct[4:8])
-
-            effect_tuples = []
-
-            for i in range(0,4):
-                effect = parseNum(attr_struct[(8+i*4):(12+i*4)])
-                skill = parseNum(attr_struct[(24+i*4):(28+i*4)])
-                attribute = parseNum(attr_struct[(40+i*4):(44+i*4)])
-
-                # even when effects don't use them, they store
-                # a skill and attribute. in order to be better
-                # about duplicate items, we want to normalize
-                # that dead data
-                #
-                # effect id referenced from openmw itself:
-                # openmw/apps/openmw/mwgui/widgets.hpp
-
-                if effect in [17, 22, 74, 79, 85]:
-                    # uses an attribute
-                    effect_tuples.append((effect, -1, attribute))
-                elif effect in [21, 26, 78, 83, 89]:
-                    # uses a skill (not common, but happens
-                    effect_tuples.append((effect, skill, -1))
-                else:
-                    effect_tuples.append((effect, -1, -1))
-
-            ingrrec['effects_hash'] = tuple(effect_tuples)
-            ingrrec['effects'] = effect_tuples
-        else:
-            print("unknown subrecord type '%s'" % sr['type'])
-            ppRecord(rec)
+class Ingredient(object):
+    # one alchemy ingredient. a big merged mod list can have
+    # thousands of these, so they get a fixed layout instead
+    # of a dict, and the strings that tend to repeat (models,
+    # icons, scripts, plugin filenames) are interned
+
+    __slots__ = ('id', 'model', 'name', 'icon', 'script',
+                 'weight', 'value', 'effects', 'file', 'deleted')
+
+    def __init__(self):
+        self.id = ''
+        self.model = ''
+        self.name = ''
+        self.icon = ''
+        self.script = None
+        self.weight = 0.0
+        self.value = 0
+        # four empty effects, until an IRDT says otherwise
+        self.effects = [ (-1, -1, -1) ] * 4
+        self.file = ''
+        # a DELE record, which takes the id out of the game
+        self.deleted = False
+
+    @property
+    def effects_hash(self):
+        return tuple(self.effects)
+
+    def __repr__(self):
+        return 'Ingredient(%r, file=%r)' % (self.id, self.file)
+
+    def copy(self):
+        # the shuffle rewrites effects in place, so this
+        # copies those; everything else is immutable. every
+        # shuffle copies every ingredient, so this skips
+        # __init__ and sets each slot directly
+        other = Ingredient.__new__(Ingredient)
+        other.id = self.id
+        other.model = self.model
+        other.name = self.name
+        other.icon = self.icon
+        other.script = self.script
+        other.weight = self.weight
+        other.value = self.value
+        other.effects = list(self.effects)
+        other.file = self.file
+        other.deleted = self.deleted
+        return other
+
+    def asTuple(self):
+        # the cache and manifest store ingredients as plain
+        # tuples: a pickled Ingredient names the module it came
+        # from, which is __main__ when we're run as a script,
+        # and so couldn't be read back when we're imported
+        return (self.id, self.model, self.name, self.icon, self.script,
+                self.weight, self.value, self.effects, self.file, self.deleted)
+
+    @staticmethod
+    def fromTuple(t):
+        ingr = Ingredient.__new__(Ingredient)
+        (ingr.id, ingr.model, ingr.name, ingr.icon, ingr.script,
+         ingr.weight, ingr.value, ingr.effects, ingr.file, ingr.deleted) = t
+        return ingr
+
+
+def normalizeEffect(effect, skill, attribute):
+    if effect in attributeEffects:
+        return (effect, -1, attribute)
+    elif effect in skillEffects:
+        # uses a skill (not common, but happens)
+        return (effect, skill, -1)
+    else:
+        return (effect, -1, -1)
+
+def decodeIRDTs(bufs):
+    # decode a whole batch of IRDT subrecords in one pass,
+    # into columns. weight and value have one entry per
+    # IRDT; effect, skill and attribute have four each,
+    # laid out one ingredient after another
+    cols = {}
+    cols['weight'] = array('f')
+    cols['value'] = array('i')
+    cols['effect'] = array('i')
+    cols['skill'] = array('i')
+    cols['attribute'] = array('i')
+
+    for vals in irdtStruct.iter_unpack(b''.join(bufs)):
+        cols['weight'].append(vals[0])
+        cols['value'].append(vals[1])
+        cols['effect'].extend(vals[2:6])
+        cols['skill'].extend(vals[6:10])
+        cols['attribute'].extend(vals[10:14])
+
+    return cols
+
+def encodeIRDTs(ingredients):
+    # the reverse of decodeIRDTs: pack the full IRDT subrecords
+    # (header included) for a batch of ingredients into one
+    # preallocated buffer. ingredient n's subrecord starts at
+    # n * irdtSubRecordStruct.size
+    size = irdtSubRecordStruct.size
+    buf = bytearray(size * len(ingredients))
+    for (n, ingr) in enumerate(ingredients):
+        effs = ingr.effects
+        irdtSubRecordStruct.pack_into(buf, n * size, b'IRDT', irdtStruct.size,
+                                      ingr.weight, ingr.value,
+                                      effs[0][0], effs[1][0], effs[2][0], effs[3][0],
+                                      effs[0][1], effs[1][1], effs[2][1], effs[3][1],
+                                      effs[0][2], effs[1][2], effs[2][2], effs[3][2])
+    return buf
+
+def parseINGRs(recs):
+    # parse a batch of INGR records. the string subrecords are
+    # handled one by one, but the IRDT blocks get collected and
+    # decoded all at once, then handed back out
+    ingrs = []
+    irdt_bufs = []
+    irdt_owners = []
+
+    for rec in recs:
+        ingrrec = Ingredient()
+
+        for sr in rec.iterSubs():
+            if sr['type'] == 'NAME':
+                ingrrec.id = intern(parseString(sr['data']))
+            elif sr['type'] == 'MODL':
+                ingrrec.model = intern(parseString(sr['data']))
+            elif sr['type'] == 'FNAM':
+                ingrrec.name = parseString(sr['data'])
+            elif sr['type'] == 'ITEX':
+                ingrrec.icon = intern(parseString(sr['data']))
+            elif sr['type'] == 'SCRI':
+                ingrrec.script = intern(parseString(sr['data']))
+            elif sr['type'] == 'IRDT' and sr['length'] == irdtStruct.size:
+                irdt_bufs.append(sr['data'])
+                irdt_owners.append(ingrrec)
+            elif sr['type'] == 'DELE':
+                # a deletion: typically just NAME and DELE, with
+                # no IRDT, so the effects stay empty
+                ingrrec.deleted = True
+
+            # anything else isn't something we write back out,
+            # so it's skipped
+
+        ingrrec.file = intern(os.path.basename(rec.fullpath))
+        ingrs.append(ingrrec)
+
+    cols = decodeIRDTs(irdt_bufs)
+    (effects, skills, attributes) = \
+        (cols['effect'], cols['skill'], cols['attribute'])
+
+    for (n, ingrrec) in enumerate(irdt_owners):
+        ingrrec.weight = cols['weight'][n]
+        ingrrec.value = cols['value'][n]
+        ingrrec.effects = [ normalizeEffect(effects[i], skills[i], attributes[i])
+                            for i in range(n*4, n*4 + 4) ]
+
+    return ingrs
 
-    ingrrec['file'] = os.path.basename(rec['fullpath'])
+def parseINGR(rec):
+    return parseINGRs([rec])[0]
+
+def parseLeveled(rec, itemsub):
+    # LEVC and LEVI are laid out the same, apart from the
+    # subrecord type of the item ids (CNAM and INAM). we're
+    # not writing these back out, so only keep what's useful
+    # for sorting things into categories
+    levrec = { 'name': '', 'flags': 0, 'chance': 0,
+               'items': [], 'levels': [] }
+
+    for (subtype, value) in decodeRecord(rec):
+        if subtype == 'NAME':
+            levrec['name'] = value
+        elif subtype == 'DATA':
+            levrec['flags'] = value
+        elif subtype == 'NNAM':
+            levrec['chance'] = value
+        elif subtype == itemsub:
+            levrec['items'].append(value)
+        elif subtype == 'INTV' and levrec['items']:
+            levrec['levels'].append(value)
 
-    return ingrrec
+    return levrec
 
 def parseLEVC(rec):
-    # we're not writing these back out, and we're only
-    # interested in the ID and the list of items, so
-    # disregard the other info
-
-    levrec = {}
-    sr = rec['subrecords']
-
-    levrec['name'] = parseString(sr[0]['data'])
-
-    if len(sr) > 3:
-        listcount = parseNum(sr[3]['data'])
-        listitems = []
-
-        for i in range(0,listcount*2,2):
-            itemid = parseString(sr[4+i]['data'])
-            listitems.append(itemid)
-
-        levrec['items'] = listitems
-    else:
-        levrec['items'] = []
-
-    return levrec
+    return parseLeveled(rec, 'CNAM')
+
+def parseLEVI(rec):
+    return parseLeveled(rec, 'INAM')
+
+def parseALCH(rec):
+    alchrec = { 'id': '', 'model': '', 'icon': '', 'script': None,
+                'name': '', 'weight': 0.0, 'value': 0, 'autocalc': 0,
+                'effects': [] }
+    fields = { 'NAME': 'id', 'MODL': 'model', 'TEXT': 'icon',
+               'SCRI': 'script', 'FNAM': 'name' }
+
+    for (subtype, value) in decodeRecord(rec):
+        if subtype in fields:
+            alchrec[fields[subtype]] = value
+        elif subtype == 'ALDT':
+            alchrec.update(value)
+        elif subtype == 'ENAM':
+            alchrec['effects'].append(value)
+
+    return alchrec
+
+def parseMGEF(rec):
+    mgefrec = { 'icon': '', 'particle': '', 'description': '' }
+    fields = { 'ITEX': 'icon', 'PTEX': 'particle', 'DESC': 'description',
+               'CVFX': 'castvfx', 'BVFX': 'boltvfx', 'HVFX': 'hitvfx',
+               'AVFX': 'areavfx', 'CSND': 'castsound', 'BSND': 'boltsound',
+               'HSND': 'hitsound', 'ASND': 'areasound' }
+
+    for (subtype, value) in decodeRecord(rec):
+        if subtype == 'INDX':
+            mgefrec['index'] = value
+        elif subtype == 'MEDT':
+            mgefrec.update(value)
+        elif subtype in fields:
+            mgefrec[fields[subtype]] = value
+
+    return mgefrec
 
 
 def pullSubs(rec, subtype):
-    return [ s for s in rec['subrecords'] if s['type'] == subtype ]
+    return list(rec.iterSubs(subtype))
+
+class Record(object):
+    # one record from a plugin. it holds on to its raw body,
+    # and only splits that into subrecords when they're first
+    # asked for. iterSubs walks the body without splitting it
+    # all out, for callers that only want a few subrecords.
+    #
+    # stats, if set, is a plugin's counters (see
+    # newPluginStats), and counts the subrecords decoded
+
+    __slots__ = ('type', 'length', 'body', 'fullpath',
+                 'stats', '_subrecords')
+
+    def __init__(self, rectype, length, body, fullpath,
+                 subrecords=None, stats=None):
+        self.type = rectype
+        self.length = length
+        self.body = body
+        self.fullpath = fullpath
+        self.stats = stats
+        self._subrecords = subrecords
+
+    @property
+    def subrecords(self):
+        if self._subrecords is None:
+            self._subrecords = splitSubRecords(self.body)
+            if self.stats is not None:
+                self.stats['subrecords'] += len(self._subrecords)
+        return self._subrecords
+
+    def iterSubs(self, subtype=None):
+        # yields the subrecords (or just those of one type),
+        # in order. once they've been split out, use those
+        if self._subrecords is not None:
+            for sr in self._subrecords:
+                if subtype is None or sr['type'] == subtype:
+                    yield sr
+            return
+
+        body = self.body
+        end = len(body)
+        pos = 0
+        while pos < end:
+            (srtype, length) = subRecordHeaderStruct.unpack_from(body, pos)
+            srtype = srtype.decode()
+            start = pos + 8
+            pos = start + length
+            if subtype is None or srtype == subtype:
+                if self.stats is not None:
+                    self.stats['subrecords'] += 1
+                sr = {}
+                sr['type'] = srtype
+                sr['length'] = length
+                sr['data'] = body[start:pos]
+                yield sr
 
 def readHeader(ba):
     header = {}
-    header['type'] = ba[0:4].decode()
-    header['length'] = int.from_bytes(ba[4:8], 'little')
+    (rectype, length) = recordHeaderStruct.unpack_from(ba)
+    header['type'] = rectype.decode()
+    header['length'] = length
     return header
 
 def readSubRecord(ba):
     sr = {}
-    sr['type'] = ba[0:4].decode()
-    sr['length'] = int.from_bytes(ba[4:8], 'little')
+    (srtype, length) = subRecordHeaderStruct.unpack_from(ba)
+    sr['type'] = srtype.decode()
+    sr['length'] = length
     endbyte = 8 + sr['length']
     sr['data'] = ba[8:endbyte]
     return (sr, ba[endbyte:])
 
-def readRecords(filename):
-    fh = open(filename, 'rb')
-    while True:
-        headerba = fh.read(16)
-        if headerba is None or len(headerba) < 16:
-            return None
-
-        record = {}
-        header = readHeader(headerba)
-        record['type'] = header['type']
-        record['length'] = header['length']
-        record['subrecords'] = []
-        # stash the filename here (a bit hacky, but useful)
-        record['fullpath'] = filename
-
-        remains = fh.read(header['length'])
-
-        while len(remains) > 0:
-            (subrecord, restofbytes) = readSubRecord(remains)
-            record['subrecords'].append(subrecord)
-            remains = restofbytes
-
-        yield record
+def readRecords(filename, rectypes=None):
+    # if we're given a collection of record types, only those
+    # records get their subrecords split out. everything else
+    # is skipped using just the 16-byte header, which saves us
+    # from decoding all the CELL/LAND/DIAL/INFO data we never use
+    with open(filename, 'rb') as fh:
+        while True:
+            headerba = fh.read(16)
+            if headerba is None or len(headerba) < 16:
+                return None
+
+            header = readHeader(headerba)
+
+            if rectypes is not None and header['type'] not in rectypes:
+                fh.seek(header['length'], os.SEEK_CUR)
+                continue
+
+            remains = fh.read(header['length'])
+            subrecords = []
+
+            while len(remains) > 0:
+                (subrecord, restofbytes) = readSubRecord(remains)
+                subrecords.append(subrecord)
+                remains = restofbytes
+
+            record = Record(header['type'], header['length'], None,
+                            filename, subrecords)
+
+            yield record
+
+def splitSubRecords(body):
+    # walk a record body by offsets. each subrecord's data is a
+    # slice of the body, so for memoryviews nothing gets copied
+    subrecords = []
+    end = len(body)
+    pos = 0
+    while pos < end:
+        sr = {}
+        (srtype, length) = subRecordHeaderStruct.unpack_from(body, pos)
+        sr['type'] = srtype.decode()
+        sr['length'] = length
+        start = pos + 8
+        pos = start + sr['length']
+        sr['data'] = body[start:pos]
+        subrecords.append(sr)
+    return subrecords
+
+def newPluginStats(source='parsed'):
+    # counters for one plugin: where its data came from
+    # (parsed, cache or manifest), how much we read, how
+    # many records we saw versus kept, and how long it took
+    stats = {}
+    stats['source'] = source
+    stats['bytes'] = 0
+    stats['records'] = 0
+    stats['kept'] = 0
+    stats['subrecords'] = 0
+    stats['scan_time'] = 0.0
+    stats['parse_time'] = 0.0
+    return stats
+
+def walkRecords(view, filename, rectypes=None, stats=None):
+    # same as readRecords, but over a buffer that's already in
+    # memory (or mapped). records we don't want are skipped by
+    # bumping the offset past them
+    end = len(view)
+    pos = 0
+    while pos + 16 <= end:
+        (rectype, length) = recordHeaderStruct.unpack_from(view, pos)
+        rectype = rectype.decode()
+        start = pos + 16
+        pos = start + length
+
+        if stats is not None:
+            stats['records'] += 1
+
+        if rectypes is not None and rectype not in rectypes:
+            continue
+
+        if stats is not None:
+            stats['kept'] += 1
+
+        yield Record(rectype, length, view[start:pos], filename, stats=stats)
+
+def mapFile(filename):
+    # memory-map a whole file, read-only, and return a view
+    # of it. the map stays alive as long as anything still
+    # refers to the view (or slices of it)
+    with open(filename, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return memoryview(b'')
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mm)
+
+def mapRecords(filename, rectypes=None, stats=None):
+    # memory-map the plugin and hand out memoryview slices of
+    # it. the bytes only get copied once the parse* functions
+    # ask for them
+    view = mapFile(filename)
+
+    if stats is not None:
+        stats['bytes'] += len(view)
+
+    yield from walkRecords(view, filename, rectypes, stats)
 
 def oldGetRecords(filename, rectype):
-    return ( r for r in readRecords(filename) if r['type'] == rectype )
+    return mapRecords(filename, (rectype,))
 
-def getRecords(filename, rectypes):
+def getRecords(filename, rectypes, stats=None, data=None):
+    # data, if given, is the plugin's contents, already read
+    # into memory; otherwise the file gets mapped
     numtypes = len(rectypes)
     retval = [ [] for x in range(numtypes) ]
-    for r in readRecords(filename):
-        if r['type'] in rectypes:
-            for i in range(numtypes):
-                if r['type'] == rectypes[i]:
-                    retval[i].append(r)
+    if data is None:
+        records = mapRecords(filename, rectypes, stats)
+    else:
+        if stats is not None:
+            stats['bytes'] += len(data)
+        records = walkRecords(memoryview(data), filename, rectypes, stats)
+    for r in records:
+        for i in range(numtypes):
+            if r.type == rectypes[i]:
+                retval[i].append(r)
     return retval
 
+def parsePlugin(filename, data=None, inmemory=False):
+    # pull the records we care about out of one plugin, and
+    # parse them into plain python data. data, if given, is
+    # the plugin's contents, already read into memory.
+    #
+    # the result carries the plugin's identity under 'source'
+    # (see fileIdentity), hashed from the same bytes we parsed.
+    # inmemory means data didn't come from a file at all, and
+    # filename is just a name for it (see bufferIdentity)
+
+    stats = newPluginStats()
+
+    start = time.perf_counter()
+    if data is None:
+        data = mapFile(filename)
+    digest = hashlib.sha1(data).hexdigest()
+    (rtes3, rlevc, rlevi, ringr) = getRecords(filename,
+                                              ('TES3', 'LEVC', 'LEVI', 'INGR'),
+                                              stats, data)
+    stats['scan_time'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parsed = {}
+    parsed['tes3'] = [ parseTES3(x) for x in rtes3 ]
+    parsed['levc'] = [ parseLEVC(x) for x in rlevc ]
+    parsed['levi'] = [ parseLEVI(x) for x in rlevi ]
+    parsed['ingr'] = parseINGRs(ringr)
+    stats['parse_time'] = time.perf_counter() - start
+
+    parsed['stats'] = stats
+    if inmemory:
+        parsed['source'] = bufferIdentity(filename, data, digest)
+    else:
+        parsed['source'] = fileIdentity(filename, digest)
+    return parsed
+
+def streamRecords(filename, rectypes=None, stats=None, digest=None):
+    # read a plugin a record at a time, into one buffer that
+    # gets reused for every record (and only grows, to fit the
+    # biggest one). each record's body is a view of that
+    # buffer, so it's only good until the next record is read:
+    # whatever's needed from it has to be parsed out first.
+    #
+    # unwanted records are still read (into the same buffer)
+    # rather than skipped, so that digest, a hashlib object if
+    # given, sees the whole file
+    header = bytearray(16)
+    buf = bytearray(1 << 16)
+
+    with open(filename, 'rb') as fh:
+        while fh.readinto(header) == 16:
+            (rectype, length) = recordHeaderStruct.unpack_from(header)
+            rectype = rectype.decode()
+
+            if length > len(buf):
+                buf = bytearray(max(length, len(buf) * 2))
+            body = memoryview(buf)[:length]
+            if fh.readinto(body) < length:
+                return
+
+            if digest is not None:
+                digest.update(header)
+                digest.update(body)
+            if stats is not None:
+                stats['bytes'] += 16 + length
+                stats['records'] += 1
+
+            if rectypes is not None and rectype not in rectypes:
+                continue
+
+            if stats is not None:
+                stats['kept'] += 1
+
+            yield Record(rectype, length, body, filename, stats=stats)
+
+def streamPlugin(filename):
+    # parsePlugin, in bounded memory. each record is parsed as
+    # soon as it's read, and then dropped, so all that's ever
+    # held is the one record and the (small) parsed results --
+    # never the plugin itself, or its raw records.
+    #
+    # scanning and parsing are interleaved, so they're timed
+    # together, as the scan
+    stats = newPluginStats()
+    digest = hashlib.sha1()
+    parsed = { 'tes3': [], 'levc': [], 'levi': [], 'ingr': [] }
+
+    start = time.perf_counter()
+    for rec in streamRecords(filename, ('TES3', 'LEVC', 'LEVI', 'INGR'),
+                             stats, digest):
+        if rec.type == 'INGR':
+            parsed['ingr'].append(parseINGR(rec))
+        elif rec.type == 'LEVC':
+            parsed['levc'].append(parseLEVC(rec))
+        elif rec.type == 'LEVI':
+            parsed['levi'].append(parseLEVI(rec))
+        else:
+            parsed['tes3'].append(parseTES3(rec))
+    stats['scan_time'] = time.perf_counter() - start
+
+    parsed['stats'] = stats
+    parsed['source'] = fileIdentity(filename, digest.hexdigest())
+    return parsed
+
+def hashFile(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        while True:
+            chunk = fh.read(1 << 20)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def cacheFilename(cachedir, filename):
+    # one cache file per plugin, named after its full path
+    pathkey = os.path.abspath(filename).encode('utf-8', 'surrogateescape')
+    return os.path.join(cachedir, hashlib.sha1(pathkey).hexdigest() + '.pickle')
+
+def readPickle(filename, version):
+    try:
+        with open(filename, 'rb') as fh:
+            entry = pickle.load(fh)
+    except Exception:
+        # missing, truncated, or otherwise broken -- any of
+        # those just means we start over
+        return None
+
+    if not isinstance(entry, dict) or entry.get('version') != version:
+        return None
+    return entry
+
+def writeAtomically(filename, data):
+    # write to the side and rename, so an interrupted run
+    # never leaves a half-written file behind
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    tmpfile = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmpfile, 'wb') as fh:
+        fh.write(data)
+    os.replace(tmpfile, filename)
+
+def writePickle(filename, entry):
+    writeAtomically(filename, pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+
+def fileIdentity(filename, digest=None):
+    st = os.stat(filename)
+    ident = {}
+    ident['path'] = os.path.abspath(filename)
+    ident['size'] = st.st_size
+    ident['mtime'] = st.st_mtime_ns
+    ident['hash'] = digest if digest is not None else hashFile(filename)
+    return ident
+
+def bufferIdentity(name, data, digest=None):
+    # the same, for a plugin that was handed to us in memory.
+    # there's no file to compare against later, so no mtime
+    ident = {}
+    ident['path'] = name
+    ident['size'] = len(data)
+    ident['mtime'] = None
+    ident['hash'] = digest if digest is not None else hashlib.sha1(data).hexdigest()
+    return ident
+
+def identityMatches(ident, filename):
+    # does this file still look like the one we recorded? path,
+    # size and mtime matching is enough. if only the mtime has
+    # moved, fall back to comparing the contents (and remember
+    # the new mtime, if they match)
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return False
+
+    if ident['path'] != os.path.abspath(filename) \
+       or ident['size'] != st.st_size:
+        return False
+    if ident['mtime'] == st.st_mtime_ns:
+        return True
+    if ident['hash'] == hashFile(filename):
+        ident['mtime'] = st.st_mtime_ns
+        return True
+    return False
+
+def storedPlugin(parsed):
+    # parsed data the way the cache and manifest pickle it,
+    # with only builtin types (see Ingredient.asTuple)
+    stored = dict(parsed)
+    stored['ingr'] = [ ingr.asTuple() for ingr in parsed['ingr'] ]
+    return stored
+
+def restoredPlugin(stored):
+    parsed = dict(stored)
+    parsed['ingr'] = [ Ingredient.fromTuple(t) for t in stored['ingr'] ]
+    return parsed
+
+def cachedPlugin(filename, cachedir):
+    # the parsed data for a plugin from the on-disk cache, or
+    # None if it isn't there (or is out of date). an entry is
+    # keyed by path, size, mtime and content hash (see
+    # identityMatches)
+    cfile = cacheFilename(cachedir, filename)
+    entry = readPickle(cfile, cacheVersion)
+
+    if entry is None:
+        return None
+
+    mtime = entry['source']['mtime']
+    if not identityMatches(entry['source'], filename):
+        return None
+    if entry['source']['mtime'] != mtime:
+        writePickle(cfile, entry)
+
+    parsed = restoredPlugin(entry['parsed'])
+    parsed['source'] = dict(entry['source'])
+    parsed['stats'] = newPluginStats('cache')
+    parsed['stats']['bytes'] = os.path.getsize(cfile)
+    return parsed
+
+def cachePlugin(cachedir, parsed):
+    entry = {}
+    entry['version'] = cacheVersion
+    entry['source'] = dict(parsed['source'])
+    entry['parsed'] = storedPlugin(parsed)
+    writePickle(cacheFilename(cachedir, parsed['source']['path']), entry)
+
+def loadPlugin(filename, cachedir=None, data=None, stream=False):
+    # parsePlugin, but going through the on-disk cache when
+    # we have one, so the plugin is only re-parsed when it
+    # changes. with stream set, it's read with streamPlugin
+    # instead (unless it's already in memory)
+    if cachedir is not None:
+        parsed = cachedPlugin(filename, cachedir)
+        if parsed is not None:
+            return parsed
+
+    if stream and data is None:
+        parsed = streamPlugin(filename)
+    else:
+        parsed = parsePlugin(filename, data)
+
+    if cachedir is not None:
+        cachePlugin(cachedir, parsed)
+
+    return parsed
+
+def readWhole(filename, chunksize=8 << 20):
+    # read a whole file into one preallocated buffer, in big
+    # chunks
+    with open(filename, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        buf = bytearray(size)
+        view = memoryview(buf)
+        pos = 0
+        while pos < size:
+            n = fh.readinto(view[pos:pos+chunksize])
+            if not n:
+                break
+            pos += n
+    return view[:pos]
+
+class Prefetcher(object):
+    # reads files ahead of us on a background thread, so that
+    # waiting on the disk (or network) overlaps with parsing.
+    #
+    # at most `budget` bytes are held in memory at a time,
+    # counting both files that are waiting to be picked up
+    # and the one being read. a file bigger than the budget
+    # on its own is still read, just not alongside any other.
+    # files have to be picked up (with get) in order
+
+    def __init__(self, filenames, budget):
+        self.filenames = filenames
+        self.budget = budget
+        self.cond = threading.Condition()
+        self.ready = {}
+        self.held = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        for (i, f) in enumerate(self.filenames):
+            try:
+                size = os.path.getsize(f)
+            except OSError:
+                size = 0
+
+            with self.cond:
+                while not self.closed and self.held > 0 \
+                      and self.held + size > self.budget:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                self.held += size
+
+            try:
+                data = readWhole(f)
+            except Exception as e:
+                # hand the error over to whoever asks for this file
+                data = e
+
+            with self.cond:
+                self.ready[i] = (size, data)
+                self.cond.notify_all()
+
+    def get(self, i):
+        with self.cond:
+            while i not in self.ready:
+                self.cond.wait()
+            (size, data) = self.ready.pop(i)
+            self.held -= size
+            self.cond.notify_all()
+
+        if isinstance(data, Exception):
+            raise data
+        return data
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+def loadPlugins(fp_mods, cachedir=None, jobs=1, prefetch=0, stream=False):
+    # yields (filename, parsed data) for each plugin, always
+    # in load order. with more than one job, the plugins are
+    # scanned and parsed in a pool of worker processes, and
+    # only the (small) parsed data comes back to us.
+    #
+    # otherwise, with prefetch set (to a number of bytes), the
+    # plugins that need parsing are read on a background
+    # thread, up to that many bytes ahead, while we parse.
+    #
+    # stream (see streamPlugin) keeps memory down, so it
+    # overrides prefetch, which is all about holding more
+
+    if jobs > 1 and len(fp_mods) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = executor.map(loadPlugin, fp_mods, repeat(cachedir),
+                                   repeat(None), repeat(stream))
+            for (f, parsed) in zip(fp_mods, results):
+                yield (f, parsed)
+    elif prefetch > 0 and not stream:
+        cached = {}
+        if cachedir is not None:
+            for f in fp_mods:
+                cached[f] = cachedPlugin(f, cachedir)
+
+        toread = [ f for f in fp_mods if cached.get(f) is None ]
+        prefetcher = Prefetcher(toread, prefetch)
+        try:
+            n = 0
+            for f in fp_mods:
+                if cached.get(f) is not None:
+                    yield (f, cached[f])
+                    continue
+
+                parsed = parsePlugin(f, prefetcher.get(n))
+                n += 1
+                if cachedir is not None:
+                    cachePlugin(cachedir, parsed)
+                yield (f, parsed)
+        finally:
+            prefetcher.close()
+    else:
+        for f in fp_mods:
+            yield (f, loadPlugin(f, cachedir, stream=stream))
+
+def clearCache(cachedir):
+    if not os.path.isdir(cachedir):
+        return
+    for fname in os.listdir(cachedir):
+        if fname.endswith('.pickle') or fname.endswith('.tmp'):
+            os.remove(os.path.join(cachedir, fname))
+
+
 def packStringSubRecord(lbl, strval):
     str_bs = packString(strval) + bytes(1)
     l = packLong(len(str_bs))
@@ -238,62 +1102,78 @@ def packTES3(desc, numrecs, masters):
     start_bs = b'TES3'
     headerflags_bs = bytes(8)
 
-    hedr_bs = b'HEDR' + packLong(300)
-    version_bs = pack('<f', 1.0)
-
+    # version 1.0, then the file type:
     # .esp == 0, .esm == 1, .ess == 32
     # suprisingly, .omwaddon == 0, also -- figured it would have its own
-    ftype_bs = bytes(4)
+    hedr_bs = b'HEDR' + packLong(hedrStruct.size) + \
+        hedrStruct.pack(1.0, 0,
+                        packPaddedString('code copyright 2020, jmelesky', 32),
+                        packPaddedString(desc, 256),
+                        numrecs)
 
-    author_bs = packPaddedString('code copyright 2020, jmelesky', 32)
-    desc_bs = packPaddedString(desc, 256)
-    numrecs_bs = packLong(numrecs)
+    masters_bs = b''.join(packStringSubRecord('MAST', m) +
+                          packIntSubRecord('DATA', s, 8)
+                          for (m, s) in masters)
 
-    masters_bs = b''
-    for (m, s) in masters:
-        masters_bs += packStringSubRecord('MAST', m)
-        masters_bs += packIntSubRecord('DATA', s, 8)
-
-    reclen = len(hedr_bs) + len(version_bs) + len(ftype_bs) + len(author_bs) +\
-             len(desc_bs) + len(numrecs_bs) + len(masters_bs)
+    reclen = len(hedr_bs) + len(masters_bs)
     reclen_bs = packLong(reclen)
 
-    return start_bs + reclen_bs + headerflags_bs + \
-        hedr_bs + version_bs + ftype_bs + author_bs + \
-        desc_bs + numrecs_bs + masters_bs
+    return start_bs + reclen_bs + headerflags_bs + hedr_bs + masters_bs
 
 
-def packINGR(rec):
+def packINGR(rec, irdt_bs=None):
+    # irdt_bs, if given, is this ingredient's already-packed
+    # IRDT subrecord (see encodeIRDTs)
     start_bs = b'INGR'
 
     headerflags_bs = bytes(8)
 
-    id_bs = packStringSubRecord('NAME', rec['id'])
-    modl_bs = packStringSubRecord('MODL', rec['model'])
-    name_bs = packStringSubRecord('FNAM', rec['name'])
+    id_bs = packStringSubRecord('NAME', rec.id)
+    modl_bs = packStringSubRecord('MODL', rec.model)
+    name_bs = packStringSubRecord('FNAM', rec.name)
 
-    irdt_bs = b'IRDT'
-    irdt_bs += packLong(56) # this subrecord is always length 56
-    irdt_bs += packFloat(rec['weight'])
-    irdt_bs += packLong(rec['value'])
-    for i in range(0,4):
-        irdt_bs += packLong(rec['effects'][i][0])
-    for i in range(0,4):
-        irdt_bs += packLong(rec['effects'][i][1])
-    for i in range(0,4):
-        irdt_bs += packLong(rec['effects'][i][2])
+    if irdt_bs is None:
+        irdt_bs = encodeIRDTs([rec])
 
-    icon_bs = packStringSubRecord('ITEX', rec['icon'])
+    icon_bs = packStringSubRecord('ITEX', rec.icon)
     script_bs = b''
-    if 'script' in rec:
-        script_bs = packStringSubRecord('SCRI', rec['script'])
+    if rec.script is not None:
+        script_bs = packStringSubRecord('SCRI', rec.script)
 
     reclen = len(id_bs) + len(modl_bs) + len(name_bs) + \
         len(irdt_bs) + len(icon_bs) + len(script_bs)
     reclen_bs = packLong(reclen)
 
-    return start_bs + reclen_bs + headerflags_bs + id_bs + \
-        modl_bs + name_bs + irdt_bs + icon_bs + script_bs
+    return b''.join((start_bs, reclen_bs, headerflags_bs, id_bs,
+                     modl_bs, name_bs, irdt_bs, icon_bs, script_bs))
+
+def writeRecords(f, desc, masters, ingredients):
+    # stream the new module out to a binary file object one
+    # record at a time, rather than building the whole thing
+    # in memory first
+    f.write(packTES3(desc, len(ingredients), masters))
+    irdts = memoryview(encodeIRDTs(ingredients))
+    size = irdtSubRecordStruct.size
+    for (n, x) in enumerate(ingredients):
+        f.write(packINGR(x, irdts[n*size:(n+1)*size]))
+
+def writeAddon(outmod, desc, masters, ingredients):
+    # write the new module to disk.
+    #
+    # it goes to a temporary file next to the real one, which
+    # is renamed into place once it's complete. that way,
+    # nothing (OpenMW included) ever sees a half-written
+    # module, even if we get interrupted
+
+    tmpfile = '%s.%d.tmp' % (outmod, os.getpid())
+    try:
+        with open(tmpfile, 'wb') as f:
+            writeRecords(f, desc, masters, ingredients)
+        os.replace(tmpfile, outmod)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
 
 
 
@@ -306,80 +1186,396 @@ def ppSubRecord(sr):
         print("  %s, length %d" % (sr['type'], sr['length']))
 
 def ppRecord(rec):
-    print("%s, length %d" % (rec['type'], rec['length']))
-    for sr in rec['subrecords']:
+    print("%s, length %d" % (rec.type, rec.length))
+    for sr in rec.subrecords:
         ppSubRecord(sr)
 
 
-def ppINGR(rec):
-    print("Ingredient name: '%s'" % (rec['name']))
-    print("  ID: '%s', file: '%s'" % (rec['id'], rec['file']))
-    print("  Model: '%s', Icon: '%s'" % (rec['model'], rec['icon']))
-    if 'script' in rec:
-        print("  Script: '%s'" % (rec['script']))
-    print("  %10s%10s%10s" % ("effect", "skill", "attribute"))
+def ppINGR(rec, out=None):
+    out = out or sys.stdout
+    print("Ingredient name: '%s'" % (rec.name), file=out)
+    print("  ID: '%s', file: '%s'" % (rec.id, rec.file), file=out)
+    print("  Model: '%s', Icon: '%s'" % (rec.model, rec.icon), file=out)
+    if rec.script is not None:
+        print("  Script: '%s'" % (rec.script), file=out)
+    print("  %10s%10s%10s" % ("effect", "skill", "attribute"), file=out)
     for i in range(0,4):
-        print("  %10d%10d%10d" % rec['effects'][i])
+        print("  %10d%10d%10d" % rec.effects[i], file=out)
 
-def ppTES3(rec):
-    print("TES3 record, type %d, version %f" % (rec['filetype'], rec['version']))
-    print("author: %s" % rec['author'])
-    print("description: %s" % rec['desc'])
+def ppTES3(rec, out=None):
+    out = out or sys.stdout
+    print("TES3 record, type %d, version %f" % (rec['filetype'], rec['version']), file=out)
+    print("author: %s" % rec['author'], file=out)
+    print("description: %s" % rec['desc'], file=out)
 
     for (mfile, msize) in rec['masters']:
-        print("  master %s, size %d" % (mfile, msize))
-
-    print()
-
-
-
-def readCfg(cfg):
-    # first, open the file and pull all 'data' and 'content' lines, in order
-
-    data_dirs = []
-    mods = []
-    with open(cfg, 'r') as f:
-        for l in f.readlines():
-            # match of form "blah=blahblah"
-            m = re.search(r'^(.*)=(.*)$', l)
-            if m:
-                varname = m.group(1).strip()
-                # get rid of not only whitespace, but also surrounding quotes
-                varvalue = m.group(2).strip().strip('\'"')
-                if varname == 'data':
-                    data_dirs.append(varvalue)
-                elif varname == 'content':
-                    mods.append(varvalue)
-
-    # we've got the basenames of the mods, but not the full paths
-    # and we have to search through the data_dirs to find them
-    fp_mods = []
-    for m in mods:
-        for p in data_dirs:
-            full_path = os.path.join(p, m)
-            if os.path.exists(full_path):
-                fp_mods.append(full_path)
+        print("  master %s, size %d" % (mfile, msize), file=out)
+
+    print(file=out)
+
+# columns for the csv form of --dumpalchs
+ingrColumns = [ 'plugin', 'id', 'name', 'model', 'icon', 'script',
+                'weight', 'value' ] + \
+              [ '%s%d' % (col, i) for i in range(1, 5)
+                for col in ('effect', 'skill', 'attribute') ]
+
+def ingrRow(ingr):
+    # an ingredient as a flat dict, for machine-readable dumps
+    row = {}
+    row['plugin'] = ingr.file
+    row['id'] = ingr.id
+    row['name'] = ingr.name
+    row['model'] = ingr.model
+    row['icon'] = ingr.icon
+    row['script'] = ingr.script
+    row['weight'] = ingr.weight
+    row['value'] = ingr.value
+    for i in range(0, 4):
+        (row['effect%d' % (i+1)], row['skill%d' % (i+1)],
+         row['attribute%d' % (i+1)]) = ingr.effects[i]
+    return row
+
+
+def windowsUserDir():
+    # Documents/My Games/OpenMW, which on windows holds both the
+    # user config and user data. see the bottom of this file
+    # for more about SHGetFolderPath
+    #
+    # this is ugly. first, imports that only work properly on windows
+    from ctypes import create_unicode_buffer, windll
+    import ctypes.wintypes
+
+    buf = create_unicode_buffer(ctypes.wintypes.MAX_PATH)
+
+    # opaque arguments. they are, roughly, for our purposes:
+    #   - an indicator of folder owner (0 == current user)
+    #   - an id for the type of folder (5 == 'My Documents')
+    #   - an indicator for user to call from (0 same as above)
+    #   - a bunch of flags for different things
+    #     (if you want, for example, to get the default path
+    #      instead of the actual path, or whatnot)
+    #     0 == current stuff
+    #   - the variable to hold the return value
+
+    windll.shell32.SHGetFolderPathW(0, 5, 0, 0, buf)
+
+    # pull out the return value and construct the rest
+    return os.path.join(buf.value, 'My Games', 'OpenMW')
+
+def cfgTokens(localdir):
+    # the ?token? values openmw.cfg paths can start with
+    pl = sys.platform
+    tokens = { '?local?': localdir }
+
+    if pl in configPaths:
+        tokens['?userconfig?'] = os.path.expanduser(configPaths[pl])
+        tokens['?userdata?'] = os.path.expanduser(userDataPaths[pl])
+        tokens['?global?'] = globalDataPaths[pl]
+    elif pl == 'win32':
+        tokens['?userconfig?'] = windowsUserDir()
+        tokens['?userdata?'] = tokens['?userconfig?']
+        tokens['?global?'] = localdir
+
+    return tokens
+
+def parseCfgValue(value):
+    # openmw.cfg values may be wrapped in double quotes, in which
+    # case '&' escapes the next character ('&&' and '&"'). we
+    # also still take values in single quotes, like we used to
+    value = value.strip()
+    if value.startswith('"'):
+        out = []
+        i = 1
+        while i < len(value):
+            c = value[i]
+            if c == '&' and i + 1 < len(value):
+                out.append(value[i+1])
+                i += 2
+                continue
+            if c == '"':
                 break
+            out.append(c)
+            i += 1
+        return ''.join(out)
+    return value.strip("'")
+
+def resolveCfgPath(value, cfgdir, tokens):
+    # expand a leading ?token?, and make relative paths
+    # relative to the config file they came from
+    if value.startswith('?'):
+        end = value.find('?', 1)
+        if end > 0 and tokens.get(value[:end+1]):
+            value = os.path.join(tokens[value[:end+1]],
+                                 value[end+1:].lstrip('/\\'))
+    return os.path.normpath(os.path.join(cfgdir, value))
+
+def resolveConfig(cfg):
+    # read openmw.cfg the way OpenMW does, and find every
+    # content file in the data directories. returns a dict of
+    #   'configs': the config files read, in order
+    #   'data': the data directories, lowest priority first
+    #   'content': the content files, in load order
+    #   'plugins': full paths to the content files we found
+    #   'missing': content files we couldn't find
+    #
+    # that means:
+    #   - 'config=' lines chain in the openmw.cfg in another
+    #     directory, read after the current file
+    #   - 'replace=data' (or content, etc.) throws away the
+    #     values of that kind seen so far
+    #   - 'data-local=' is a data directory that comes after
+    #     all the others
+    #   - ?userdata?-style tokens at the start of paths
+    #   - later data directories win over earlier ones when
+    #     they have the same file, and file names are matched
+    #     without regard to case
+
+    values = { 'data': [], 'data-local': [], 'content': [] }
+    configs = []
+    queue = [ os.path.abspath(cfg) ]
+    tokens = cfgTokens(os.path.dirname(queue[0]))
+
+    while queue:
+        cfgfile = queue.pop(0)
+        if cfgfile in configs or not os.path.isfile(cfgfile):
+            continue
+        configs.append(cfgfile)
+        cfgdir = os.path.dirname(cfgfile)
+        chained = []
+
+        with open(cfgfile, 'r', encoding='utf-8', errors='replace') as f:
+            for l in f:
+                l = l.strip()
+                if not l or l.startswith('#'):
+                    continue
+                (varname, eq, varvalue) = l.partition('=')
+                if not eq:
+                    continue
+                varname = varname.strip()
+                varvalue = parseCfgValue(varvalue)
+
+                if varname == 'replace':
+                    if varvalue in values:
+                        values[varvalue] = []
+                    elif varvalue == 'config':
+                        chained = []
+                elif varname in ('data', 'data-local'):
+                    values[varname].append(resolveCfgPath(varvalue, cfgdir, tokens))
+                elif varname == 'content':
+                    values['content'].append(varvalue)
+                elif varname == 'config':
+                    chained.append(os.path.join(resolveCfgPath(varvalue, cfgdir, tokens),
+                                                configFilename))
+
+        queue = chained + queue
+
+    data_dirs = values['data'] + values['data-local']
+
+    # one listing per data directory, folded into a single
+    # lowercase index. later directories overwrite earlier
+    # ones, which gives us OpenMW's priority order
+
+    index = {}
+    for d in data_dirs:
+        try:
+            names = os.listdir(d)
+        except OSError:
+            continue
+        for name in names:
+            index[name.lower()] = os.path.join(d, name)
+
+    plugins = []
+    missing = []
+    for m in values['content']:
+        full_path = index.get(m.lower())
+        if full_path is None:
+            missing.append(m)
+        else:
+            plugins.append(full_path)
+
+    resolved = {}
+    resolved['configs'] = configs
+    resolved['data'] = data_dirs
+    resolved['content'] = values['content']
+    resolved['plugins'] = plugins
+    resolved['missing'] = missing
+    return resolved
+
+def reportMissing(missing, out=None):
+    # the plugins openmw.cfg lists that aren't in any data
+    # directory, which everything else carries on without
+    out = out or sys.stdout
+    for m in missing:
+        out.write("Couldn't find '%s' in any data directory, skipping it\n" % m)
 
-    print("Config file parsed...")
+def readCfg(cfg):
+    order = resolveLoadOrder(cfg)
 
-    return fp_mods
+    reportMissing(order.missing)
 
+    print("Config file parsed...")
 
-def dumpalchs(cfg):
-    alchs = []
-    fp_mods = readCfg(cfg)
+    return order.plugins
 
-    for f in fp_mods:
-        [ ppTES3(parseTES3(x)) for x in oldGetRecords(f, 'TES3') ]
+def readTES3Header(filename):
+    # just the TES3 record at the front of a plugin, parsed,
+    # without reading any further. None if the file doesn't
+    # start with one (or it's cut short)
+    with open(filename, 'rb') as fh:
+        header = fh.read(16)
+        if len(header) < 16:
+            return None
+        (rectype, length) = recordHeaderStruct.unpack_from(header)
+        if rectype != b'TES3':
+            return None
+        body = fh.read(length)
+        if len(body) < length:
+            return None
+    return parseTES3(Record('TES3', length, body, filename))
+
+def probeLoadOrder(cfg):
+    # check a load order using nothing but the TES3 headers of
+    # its plugins, which takes next to no time. returns a dict
+    # of
+    #   'order': the LoadOrder
+    #   'headers': the parsed header of each plugin found, in
+    #     load order (None for ones that don't have one)
+    #   'records': the number of records the headers add up to
+    #   'problems': (plugin, message) for everything wrong:
+    #     plugins that couldn't be found, or have no header, and
+    #     masters that are missing, load too late, or aren't the
+    #     size the plugin was saved against
+    order = resolveLoadOrder(cfg)
+    problems = [ (m, "couldn't be found in any data directory")
+                 for m in order.missing ]
+
+    positions = { os.path.basename(f).lower(): n
+                  for (n, f) in enumerate(order.plugins) }
+    missing = set(m.lower() for m in order.missing)
+
+    headers = []
+    records = 0
+    for (n, f) in enumerate(order.plugins):
+        name = os.path.basename(f)
+        try:
+            tes3 = readTES3Header(f)
+        except OSError:
+            tes3 = None
+        headers.append(tes3)
+
+        if tes3 is None:
+            problems.append((name, "doesn't start with a TES3 header"))
+            continue
+        records += tes3.get('numrecords', 0)
+
+        for (master, size) in tes3['masters']:
+            pos = positions.get(master.lower())
+            if pos is None:
+                if master.lower() in missing:
+                    why = "which couldn't be found"
+                else:
+                    why = "which isn't in the load order"
+                problems.append((name, "needs master '%s', %s" % (master, why)))
+            elif pos > n:
+                problems.append((name, "needs master '%s', which loads after it" % master))
+            elif size and size != os.path.getsize(order.plugins[pos]):
+                problems.append((name, "was saved against a different '%s' "
+                                 "(%d bytes, but it's %d now)"
+                                 % (master, size, os.path.getsize(order.plugins[pos]))))
+
+    probe = {}
+    probe['order'] = order
+    probe['headers'] = headers
+    probe['records'] = records
+    probe['problems'] = problems
+    return probe
+
+def printProbe(probe, elapsed):
+    # the --probe report. returns whether the load order passed
+    order = probe['order']
+    for (f, tes3) in zip(order.plugins, probe['headers']):
+        if tes3 is not None:
+            print("%-40s%10d records%5d masters" % (os.path.basename(f),
+                                                   tes3.get('numrecords', 0),
+                                                   len(tes3['masters'])))
 
-    for f in fp_mods:
-        ingrs = [ parseINGR(x) for x in oldGetRecords(f, 'INGR') ]
-        [ ppINGR(x) for x in ingrs ]
+    print()
+    for (plugin, message) in probe['problems']:
+        print("%s %s" % (plugin, message))
 
+    print("%d plugins, %d records, %d problems (checked in %.3fs)"
+          % (len(order.plugins), probe['records'], len(probe['problems']), elapsed))
+    return not probe['problems']
 
 
-def shuffle_ingredients(ingredients):
+def dumpalchs(cfg, fmt='text', out=None, plugins=None, idpattern=None,
+              effects=None, limit=None):
+    # dump the ingredients in every plugin, as we read them.
+    # each plugin is read once, for both its TES3 header and its
+    # ingredients, and nothing is held on to.
+    #
+    #   fmt: 'text' (for people), 'jsonl' or 'csv'
+    #   out: file to write to, default stdout
+    #   plugins: glob the plugin file names have to match
+    #   idpattern: regex the ingredient IDs have to match
+    #   effects: collection of effect ids, at least one of
+    #     which the ingredient has to have
+    #   limit: stop after this many ingredients
+    #
+    # ids and plugin names are matched regardless of case. only
+    # the text form includes the TES3 headers, so that the
+    # other forms are one ingredient per line/row
+
+    out = out or sys.stdout
+    resolved = resolveConfig(cfg)
+    reportMissing(resolved['missing'], sys.stderr)
+
+    idmatch = re.compile(idpattern, re.IGNORECASE).search if idpattern else None
+    effects = frozenset(effects) if effects else None
+
+    writer = None
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, ingrColumns)
+        writer.writeheader()
+
+    count = 0
+    if limit is not None and limit < 1:
+        return
+
+    for f in resolved['plugins']:
+        if plugins and not fnmatch.fnmatch(os.path.basename(f).lower(),
+                                           plugins.lower()):
+            continue
+
+        for rec in mapRecords(f, ('TES3', 'INGR')):
+            if rec.type == 'TES3':
+                if fmt == 'text':
+                    print("%s:" % f, file=out)
+                    ppTES3(parseTES3(rec), out)
+                continue
+
+            ingr = parseINGR(rec)
+
+            if ingr.deleted:
+                continue
+            if idmatch and not idmatch(ingr.id):
+                continue
+            if effects and not any(e[0] in effects for e in ingr.effects):
+                continue
+
+            if fmt == 'jsonl':
+                out.write(json.dumps(ingrRow(ingr)) + '\n')
+            elif fmt == 'csv':
+                writer.writerow(ingrRow(ingr))
+            else:
+                ppINGR(ingr, out)
+
+            count += 1
+            if limit is not None and count >= limit:
+                return
+
+
+def shuffle_ingredients(ingredients, rng):
     # Okay, here's what we're doing.
     #
     # First, let's take out all the ingredients that
@@ -389,14 +1585,14 @@ def shuffle_ingredients(ingredients):
     final_ingredients = {}
 
     for ingr in ingredients.values():
-        if ingr['effects'][0][0] < 0 \
-           and ingr['effects'][1][0] < 0 \
-           and ingr['effects'][2][0] < 0 \
-           and ingr['effects'][3][0] < 0:
-            final_ingredients[ingr['id']] = ingr
+        if ingr.effects[0][0] < 0 \
+           and ingr.effects[1][0] < 0 \
+           and ingr.effects[2][0] < 0 \
+           and ingr.effects[3][0] < 0:
+            final_ingredients[ingr.id] = ingr
 
     for ingr in final_ingredients.values():
-        del ingredients[ingr['id']]
+        del ingredients[ingr.id]
 
     # Next, we're going to build four lists, one
     # each for the first, second, third, and fourth
@@ -415,8 +1611,8 @@ def shuffle_ingredients(ingredients):
     effect_lists = [[],[],[],[]]
     for i in range(0,4):
         for ingr in ingredients.values():
-            if ingr['effects'][i][0] > 0:
-                effect_lists[i].append(ingr['effects'][i])
+            if ingr.effects[i][0] > 0:
+                effect_lists[i].append(ingr.effects[i])
 
     # Next, we shuffle the ingredients, then go
     # through each effect, assigning it to an
@@ -427,109 +1623,678 @@ def shuffle_ingredients(ingredients):
     ingr_array = [ x for x in ingredients.values() ]
 
     for i in range(0,4):
-        shuffle(ingr_array)
+        rng.shuffle(ingr_array)
         total_effects = len(effect_lists[i])
         for j in range(0,total_effects):
-            ingr_array[j]['effects'][i] = effect_lists[i][j]
+            ingr_array[j].effects[i] = effect_lists[i][j]
         if len(ingr_array) > total_effects:
             for ingr in ingr_array[total_effects:]:
-                final_ingredients[ingr['id']] = ingr
+                final_ingredients[ingr.id] = ingr
             del ingr_array[total_effects:]
 
 
     # and then slap the rest in
 
     for ingr in ingr_array:
-        final_ingredients[ingr['id']] = ingr
+        final_ingredients[ingr.id] = ingr
 
     return final_ingredients
 
 
 
-def main(cfg, outmoddir, outmod):
-    fp_mods = readCfg(cfg)
-
-    # first, let's grab the "raw" records from the files
-
-    (rtes3, rlevc, ringr) = ([], [], [])
-    for f in fp_mods:
-        print("Parsing '%s' for relevant records" % f)
-        (rtes3t, rlevct, ringrt) = getRecords(f, ('TES3', 'LEVC', 'INGR'))
-        rtes3 += rtes3t
-        rlevc += rlevct
-        ringr += ringrt
+def shuffle_ingredients_constrained(ingredients, rng, maxshare=None):
+    # A stricter take on shuffle_ingredients. It keeps the same
+    # per-slot effect lists (so effect proportions stay about the
+    # same), but makes sure that:
+    #
+    #   - no ingredient ends up with the same effect twice
+    #   - every effect is on at least two ingredients, so
+    #     anything that shows up can actually be brewed
+    #   - (optionally) no effect is on more than maxshare
+    #     ingredients
+    #
+    # It does that with a couple of repair passes rather than
+    # by retrying shuffles, so it stays near-linear in the
+    # number of ingredients.
 
-    # next, parse the tes3 records so we can get a list
-    # of master files required by all our mods
+    final_ingredients = {}
 
-    tes3list = [ parseTES3(x) for x in rtes3 ]
+    # First, same as always, the ingredients without effects
+    # stay as they are
 
-    masters = {}
-    for t in tes3list:
-        for m in t['masters']:
-            masters[m[0]] = m[1]
+    for ingr in ingredients.values():
+        if ingr.effects[0][0] < 0 \
+           and ingr.effects[1][0] < 0 \
+           and ingr.effects[2][0] < 0 \
+           and ingr.effects[3][0] < 0:
+            final_ingredients[ingr.id] = ingr
 
-    master_list = [ (k,v) for (k,v) in masters.items() ]
+    for ingr in final_ingredients.values():
+        del ingredients[ingr.id]
 
-    # parse the levc records -- we want to sort things
-    # as food, if the appear in a food leveled list
+    # Next, the four per-slot effect lists. Effect 0 (Water
+    # Breathing) is a real effect, so unlike the classic
+    # shuffle, it's counted
 
-    levclist = [ parseLEVC(x) for x in rlevc ]
+    effect_lists = [[],[],[],[]]
+    for i in range(0,4):
+        for ingr in ingredients.values():
+            if ingr.effects[i][0] >= 0:
+                effect_lists[i].append(ingr.effects[i])
+
+    # Now repair the lists themselves. Whenever we need to take
+    # an occurrence of an effect away, take it from the latest
+    # slot we can, so first effects keep their proportions
+
+    counts = {}
+    positions = {}
+    for (i, el) in enumerate(effect_lists):
+        for (j, eff) in enumerate(el):
+            counts[eff] = counts.get(eff, 0) + 1
+            positions.setdefault(eff, []).append((i, j))
+
+    def replaceOne(old, new):
+        # positions are in slot order, so pop() gives the latest
+        if not positions[old]:
+            return False
+        (i, j) = positions[old].pop()
+        effect_lists[i][j] = new
+        counts[old] -= 1
+        if new is not None:
+            positions.setdefault(new, []).insert(0, (i, j))
+            counts[new] = counts.get(new, 0) + 1
+        return True
+
+    def dropOne(eff):
+        # never from the first slot, so every ingredient keeps
+        # at least one effect
+        pos = positions[eff]
+        for k in range(len(pos) - 1, -1, -1):
+            if pos[k][0] > 0:
+                (i, j) = pos.pop(k)
+                effect_lists[i][j] = None
+                counts[eff] -= 1
+                return True
+        return False
+
+    def makeRoom(eff):
+        # drop a later-slot occurrence of some other effect,
+        # so it has room for one of eff's. returns that effect,
+        # or None if only first effects are left anywhere
+        for other in counts:
+            if other != eff and counts[other] >= 2 and dropOne(other):
+                return other
+        return None
+
+    #  - effects over the cap give their surplus to the
+    #    least common effects that still have room. if none
+    #    do, the surplus is dropped from the later slots, or,
+    #    if all that's left of it is first effects, handed to
+    #    an effect that drops one of its later ones to make
+    #    room. only if there are no later effects left at all
+    #    can the cap not be met, and then they stay
+
+    if maxshare is not None and maxshare >= 2:
+        for eff in sorted(counts, key=lambda e: -counts[e]):
+            while counts[eff] > maxshare:
+                under = [ e for e in counts if counts[e] < maxshare and e != eff ]
+                if under:
+                    replaceOne(eff, min(under, key=lambda e: counts[e]))
+                elif not dropOne(eff):
+                    other = makeRoom(eff)
+                    if other is None:
+                        break
+                    replaceOne(eff, other)
+
+    #  - effects on only one ingredient borrow an occurrence
+    #    from the most common effect that can spare one
+
+    for eff in [ e for e in counts if counts[e] == 1 ]:
+        donor = max(counts, key=lambda e: counts[e])
+        if counts[donor] <= 2 or donor == eff:
+            break
+        replaceOne(donor, eff)
+
+    effect_lists = [ [ e for e in el if e is not None ] for el in effect_lists ]
+
+    # Then hand out the effects, slot by slot. As with the
+    # classic shuffle, the ingredients that don't get an effect
+    # in one slot are done, and any effects they had from that
+    # slot on are cleared
+
+    have = {}
+    for ingr in ingredients.values():
+        have[ingr.id] = set()
 
-    # get a list of items that appear in lists of "food"
+    ingr_array = [ x for x in ingredients.values() ]
 
-    foodset = set()
-    for ll in levclist:
-        if 'food' in ll['name'] or 'Food' in ll['name']:
-            for ingr in ll['items']:
-                foodset.add(ingr)
+    def fits(ingr, eff):
+        return eff not in have[ingr.id]
 
-    # now parse the ingredients entries.
+    for i in range(0,4):
+        rng.shuffle(ingr_array)
+        effs = list(effect_lists[i])
+        rng.shuffle(effs)
+        total_effects = min(len(effs), len(ingr_array))
+        n = len(ingr_array)
+
+        for j in range(0, total_effects):
+            if fits(ingr_array[j], effs[j]):
+                continue
+
+            # a clash: look for another effect in this slot we
+            # can swap with (both ways round has to work), and
+            # failing that, an ingredient that won't get an
+            # effect in this slot to trade places with. start
+            # from a random spot, so we don't pile up at the front
+            start = rng.randrange(total_effects)
+            for k in range(total_effects):
+                k = (start + k) % total_effects
+                if k != j and fits(ingr_array[k], effs[j]) \
+                   and fits(ingr_array[j], effs[k]):
+                    (effs[j], effs[k]) = (effs[k], effs[j])
+                    break
+            else:
+                for m in range(total_effects, n):
+                    if fits(ingr_array[m], effs[j]):
+                        (ingr_array[j], ingr_array[m]) = (ingr_array[m], ingr_array[j])
+                        break
+
+            # if neither worked, the pool is too small (or too
+            # samey) to avoid the duplicate, and we let it be
+
+        for j in range(0, total_effects):
+            ingr_array[j].effects[i] = effs[j]
+            have[ingr_array[j].id].add(effs[j])
+
+        for ingr in ingr_array[total_effects:]:
+            for k in range(i, 4):
+                ingr.effects[k] = (-1, -1, -1)
+            final_ingredients[ingr.id] = ingr
+        del ingr_array[total_effects:]
 
-    ilist = [ parseINGR(x) for x in ringr ]
+    for ingr in ingr_array:
+        final_ingredients[ingr.id] = ingr
 
-    # we need to uniquify the list -- mods may alter
-    # Vanilla ingredients by replacing them
+    return final_ingredients
 
-    ingrs_by_id = {}
+class ColumnarPool(object):
+    # a pool of ingredients, encoded for
+    # shuffle_ingredients_columnar. each distinct effect gets
+    # a code, so the whole pool is an N x 4 matrix of them.
+    # none of that depends on the seed, so it's worked out
+    # once and reused for every shuffle of the same pool
+
+    __slots__ = ('ingrs', 'effects', 'codes', 'fixed', 'rows', 'slots')
+
+    def __init__(self, ingredients):
+        self.ingrs = list(ingredients.values())
+
+        flat = list(chain.from_iterable(x.effects for x in self.ingrs))
+        self.effects = list(dict.fromkeys(flat))
+        table = { e: n for (n, e) in enumerate(self.effects) }
+        self.codes = numpy.fromiter(map(table.__getitem__, flat), dtype=numpy.int32,
+                                    count=len(flat)).reshape(len(self.ingrs), 4)
+        ids = numpy.array([ e[0] for e in self.effects ], dtype=numpy.int32)[self.codes]
+
+        # the ingredients without any effects (which stay as
+        # they are), the ones with, and each slot's effects, in
+        # ingredient order
+
+        noeffects = (ids < 0).all(axis=1)
+        self.fixed = numpy.flatnonzero(noeffects)
+        self.rows = numpy.flatnonzero(~noeffects)
+        self.slots = [ self.codes[self.rows, i][ids[self.rows, i] > 0]
+                       for i in range(0, 4) ]
+
+def shuffle_ingredients_columnar(ingredients, rng, pool=None):
+    # the same shuffle as shuffle_ingredients, with numpy, and
+    # with the same proportions of effects in each slot. rng
+    # is a numpy Generator, and pool, if given, is the
+    # ColumnarPool for these ingredients.
+    #
+    # each slot is one permutation of the rows still in play,
+    # and one scatter of that slot's effects into the first
+    # of them. the permutations come from numpy rather than
+    # python, so a seed gives a different (but just as
+    # repeatable) shuffle than with 'classic'. unlike the
+    # other shuffles, this one leaves ingredients alone, and
+    # hands back shuffled copies
+
+    if pool is None:
+        pool = ColumnarPool(ingredients)
+    if not pool.ingrs:
+        return {}
+
+    # the ingredients without effects come first. rows that
+    # miss out on a slot keep the rest of their effects and
+    # are done
+
+    order = [ pool.fixed ]
+    shuffled = pool.codes.copy()
+    rest = pool.rows
+    for (i, slot) in enumerate(pool.slots):
+        rest = rest[rng.permutation(len(rest))]
+        shuffled[rest[:len(slot)], i] = slot
+        order.append(rest[len(slot):])
+        rest = rest[:len(slot)]
+    order.append(rest)
+
+    order = numpy.concatenate(order)
+    (ingrs, effects) = (pool.ingrs, pool.effects)
+    final = {}
+    for (n, (a, b, c, d)) in zip(order.tolist(), shuffled[order].tolist()):
+        ingr = ingrs[n].copy()
+        ingr.effects = [ effects[a], effects[b], effects[c], effects[d] ]
+        final[ingr.id] = ingr
+    return final
+
+def columnarPools(collected):
+    # the ColumnarPools for the foods and non-foods, made the
+    # first time they're asked for, and kept in collected
+    # after that so later seeds don't encode them again
+    pools = collected['columnar']
+    if not pools:
+        pools['foods'] = ColumnarPool(collected['foods'])
+        pools['nonfoods'] = ColumnarPool(collected['nonfoods'])
+    return (pools['foods'], pools['nonfoods'])
+
+# the shuffle algorithms to pick from. 'columnar' needs numpy
+# (see usableAlgorithm)
+shuffleAlgorithms = ('classic', 'constrained', 'columnar')
+
+def usableAlgorithm(algorithm):
+    # 'columnar' falls back to 'classic' without numpy. this is
+    # the algorithm that will actually run, which is what should
+    # be recorded (a seed shuffles differently under each)
+    if algorithm == 'columnar' and numpy is None:
+        return 'classic'
+    return algorithm
+
+
+class Progress(object):
+    # a one-line progress display for loading plugins, on
+    # stderr, rewritten in place (or, when that isn't a
+    # terminal, a line per plugin, so logs don't fill up with
+    # escape codes). it goes by the record counts
+    # in the plugins' TES3 headers (see readTES3Header), so the
+    # total is known before anything is parsed, and the time
+    # left is estimated from how quickly records have gone by
+
+    def __init__(self, counts, out=None):
+        # counts: the number of records in each plugin to load
+        self.total = sum(counts)
+        self.plugins = len(counts)
+        self.done = 0
+        self.loaded = 0
+        self.start = time.perf_counter()
+        self.out = out or sys.stderr
+        self.inplace = self.out.isatty()
+
+    def advance(self, filename, records):
+        self.done += records
+        self.loaded += 1
+
+        elapsed = time.perf_counter() - self.start
+        eta = ''
+        if 0 < self.done < self.total:
+            eta = ', about %ds left' % (elapsed * (self.total - self.done) / self.done + 0.5)
+        percent = 100 * self.done // self.total if self.total else 100
+
+        line = "Loaded %d/%d plugins (%d%% of %d records%s): %s" \
+            % (self.loaded, self.plugins, percent, self.total, eta,
+               os.path.basename(filename))
+        if not self.inplace:
+            self.out.write(line + "\n")
+        else:
+            self.out.write("\r\x1b[K" + line)
+            if self.loaded == self.plugins:
+                self.out.write("\n")
+        self.out.flush()
+
+def headerRecords(filename):
+    # the record count from a plugin's header, or 0 if it
+    # doesn't have a usable one
+    try:
+        tes3 = readTES3Header(filename)
+    except OSError:
+        tes3 = None
+    return tes3.get('numrecords', 0) if tes3 is not None else 0
+
+def peakRSS():
+    # the process' peak resident set size so far, in bytes,
+    # or None where we can't tell
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+class Timings(object):
+    # instrumentation for a run: wall and cpu time for each
+    # phase, the peak RSS as of the end of each phase, and
+    # (if trace_memory is set) the peak traced python memory
+    # during each phase. also collects the per-plugin counters
+    # from newPluginStats.
+    #
+    # cpu time only counts this process, so with --jobs the
+    # work done by the workers shows up as wall time in the
+    # 'load' phase, and in the per-plugin times
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.phases = []
+        self.plugins = []
+
+    @contextmanager
+    def phase(self, name):
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            ph = {}
+            ph['name'] = name
+            ph['wall'] = time.perf_counter() - wall
+            ph['cpu'] = time.process_time() - cpu
+            ph['peak_rss'] = peakRSS()
+            if self.trace_memory:
+                ph['peak_traced'] = tracemalloc.get_traced_memory()[1]
+            self.phases.append(ph)
+
+    def addPlugin(self, filename, stats):
+        entry = { 'plugin': filename }
+        entry.update(stats)
+        self.plugins.append(entry)
+
+    def asDict(self):
+        return { 'phases': self.phases, 'plugins': self.plugins }
+
+    def dumpJSON(self, filename):
+        if filename == '-':
+            json.dump(self.asDict(), sys.stdout, indent=2)
+            print()
+        else:
+            with open(filename, 'w') as f:
+                json.dump(self.asDict(), f, indent=2)
+
+    def printTable(self):
+        def mb(n):
+            return '-' if n is None else '%.1f' % (n / 1e6)
+
+        print("%-12s%10s%10s%14s%14s" % ("phase", "wall s", "cpu s", "peak RSS MB", "traced MB"))
+        for ph in self.phases:
+            print("%-12s%10.3f%10.3f%14s%14s" % (ph['name'], ph['wall'], ph['cpu'],
+                                               mb(ph['peak_rss']),
+                                               mb(ph.get('peak_traced'))))
+        print()
+
+        print("%-30s%9s%10s%10s%10s%12s%9s%9s" % ("plugin", "source", "MB read", "records",
+                                                 "kept", "subrecords", "scan s", "parse s"))
+        for pl in self.plugins:
+            print("%-30s%9s%10s%10d%10d%12d%9.3f%9.3f" % (os.path.basename(pl['plugin'])[:29],
+                                                         pl['source'], mb(pl['bytes']),
+                                                         pl['records'], pl['kept'],
+                                                         pl['subrecords'], pl['scan_time'],
+                                                         pl['parse_time']))
+        print()
+
+
+def normalizeId(ident):
+    # record ids are matched without regard to case, by the
+    # game and by OpenMW
+    return ident.lower()
+
+def overrideIndex(ilist, loadorder=None):
+    # one pass over the ingredients, in load order. loadorder
+    # maps each plugin's file name to where it is in the load
+    # order (by default, plugins are numbered as they show up
+    # in ilist, which skips any without ingredients). returns
+    #   - the winning (last loaded) ingredient for each id, in
+    #     the order the ids were first seen. an id whose last
+    #     record deletes it has no winner
+    #   - the override chain for each id: (plugin, load order
+    #     position, position) for every record of it, first
+    #     loaded first. position counts the ingredients in that
+    #     plugin. both count from 0
+    # both keyed by normalizeId
+    if loadorder is None:
+        loadorder = {}
+        for ingr in ilist:
+            loadorder.setdefault(ingr.file, len(loadorder))
+
+    winners = {}
+    chains = {}
+    positions = {}
     for ingr in ilist:
-        ingrs_by_id[ingr['id']] = ingr
+        key = normalizeId(ingr.id)
+        pos = positions.get(ingr.file, 0)
+        positions[ingr.file] = pos + 1
 
-    # look for ingredients that
-    #   1- use the same models as each other
-    #   2- have identical effects
-    #
-    # stash all but one of those ingredients so we
-    # can maintain that consistency
+        if ingr.deleted:
+            winners.pop(key, None)
+        else:
+            winners[key] = ingr
+        entry = (ingr.file, loadorder[ingr.file], pos)
+        if key in chains:
+            chains[key].append(entry)
+        else:
+            chains[key] = [ entry ]
+    return (winners, chains)
+
+def findDupes(ingrs):
+    # the groups of ingredients that share a model and have
+    # identical effects, each in load order (so the first one
+    # can be the anchor). groups come out ordered by where
+    # their model first shows up, then by where they do
 
     ingrs_by_model = {}
-    for ingr in ingrs_by_id.values():
-        if ingr['model'] in ingrs_by_model:
-            ingrs_by_model[ingr['model']].append(ingr)
+    for ingr in ingrs:
+        if ingr.model in ingrs_by_model:
+            ingrs_by_model[ingr.model].append(ingr)
         else:
-            ingrs_by_model[ingr['model']] = [ ingr ]
+            ingrs_by_model[ingr.model] = [ ingr ]
 
-    dupe_ingrs = {}
+    dupelists = []
     for (model, ingrlist) in ingrs_by_model.items():
         if len(ingrlist) > 1:
             # now find out if they have matched
             # effects
             by_effect = {}
             for ingr in ingrlist:
-                if ingr['effects_hash'] in by_effect:
-                    by_effect[ingr['effects_hash']].append(ingr)
+                if ingr.effects_hash in by_effect:
+                    by_effect[ingr.effects_hash].append(ingr)
                 else:
-                    by_effect[ingr['effects_hash']] = [ ingr ]
+                    by_effect[ingr.effects_hash] = [ ingr ]
 
             for dupelist in by_effect.values():
                 if len(dupelist) > 1:
-                    # select one id to map the dupes
-                    anchor_id = dupelist[0]['id']
-                    # stash the dupes
-                    dupe_ingrs[anchor_id] = dupelist[1:]
-                    # remove the dupes from the main set
-                    for dupe in dupelist[1:]:
-                        del ingrs_by_id[dupe['id']]
+                    dupelists.append(dupelist)
+
+    return dupelists
+
+def findDupesColumnar(ingrs):
+    # findDupes, with numpy. each ingredient becomes a single
+    # number, from codes for its model and for its effects
+    # (both numbered in order of first appearance), and one
+    # unique() over those does the grouping
+    if len(ingrs) < 2:
+        return []
+
+    models = {}
+    effects = {}
+    keys = numpy.fromiter(((models.setdefault(x.model, len(models)) << 32)
+                           | effects.setdefault(x.effects_hash, len(effects))
+                           for x in ingrs),
+                          dtype=numpy.int64, count=len(ingrs))
+
+    (keys, first, inverse, counts) = numpy.unique(keys, return_index=True,
+                                                  return_inverse=True,
+                                                  return_counts=True)
+
+    # the members of each group are a run in this ordering,
+    # in load order within the run
+    members = numpy.argsort(inverse.reshape(-1), kind='stable')
+    ends = numpy.cumsum(counts)
+
+    groups = numpy.flatnonzero(counts > 1)
+    groups = groups[numpy.lexsort((first[groups], keys[groups] >> 32))]
+
+    return [ [ ingrs[k] for k in members[ends[g] - counts[g]:ends[g]] ]
+             for g in groups.tolist() ]
+
+def leveledIndex(lists):
+    # an inverted index of leveled lists (LEVC and LEVI alike),
+    # from the normalizeId of each item to the names of the
+    # lists it's in. lists are overridden like anything else,
+    # so only the last definition of each one counts
+    latest = {}
+    for ll in lists:
+        latest[normalizeId(ll['name'])] = ll
+
+    index = {}
+    for ll in latest.values():
+        for item in ll['items']:
+            key = normalizeId(item)
+            if key in index:
+                if ll['name'] not in index[key]:
+                    index[key].append(ll['name'])
+            else:
+                index[key] = [ ll['name'] ]
+    return index
+
+class Classifier(object):
+    # sorts ingredients into a category (food, by default).
+    # an ingredient is in it if it's in any leveled list that
+    # matches -- by name, or by one of the regexes -- or if
+    # its own id matches one of the regexes. the regexes are
+    # compiled into one, up front, and list names are matched
+    # without regard to case
+
+    __slots__ = ('name', 'pattern', 'listnames')
+
+    def __init__(self, name, patterns=(), listnames=()):
+        self.name = name
+        self.pattern = None
+        if patterns:
+            self.pattern = re.compile('|'.join('(?:%s)' % p for p in patterns))
+        self.listnames = frozenset(normalizeId(n) for n in listnames)
+
+    def matchesList(self, listname):
+        return normalizeId(listname) in self.listnames or \
+            (self.pattern is not None and self.pattern.search(listname) is not None)
+
+    def matchesId(self, ident):
+        return self.pattern is not None and self.pattern.search(ident) is not None
+
+    def members(self, index):
+        # the normalized ids of every item in a matching list.
+        # each list is only checked once, however many items
+        # it has, and after that it's one set lookup per item
+        verdicts = {}
+        members = set()
+        for (key, names) in index.items():
+            for n in names:
+                if n not in verdicts:
+                    verdicts[n] = self.matchesList(n)
+                if verdicts[n]:
+                    members.add(key)
+                    break
+        return members
+
+    def settings(self):
+        # everything that decides what it matches, for
+        # comparing against the last run's (see main)
+        return (self.name, self.pattern.pattern if self.pattern is not None else None,
+                tuple(sorted(self.listnames)))
+
+    def __repr__(self):
+        return 'Classifier(%r)' % self.name
+
+# what's been counted as food all along: anything in a
+# leveled list with "food" in its name, or with "food" in its
+# own id
+defaultFoodPatterns = ('[Ff]ood',)
+
+def foodClassifier(patterns=None, listnames=None):
+    # the classifier for food. with neither patterns nor list
+    # names, it's the default one
+    if not patterns and not listnames:
+        patterns = defaultFoodPatterns
+    return Classifier('food', patterns or (), listnames or ())
+
+def collectIngredients(plugins, classifier=None):
+    # takes the parsed data from each plugin, in load order,
+    # and works out everything the shuffle needs: the masters
+    # for the new module, the food and non-food ingredients
+    # (according to classifier, by default foodClassifier()),
+    # and the duplicates that should follow an "anchor". the
+    # override chains and the leveled list index come along
+    # too, for reporting and anything else that wants them
+
+    if classifier is None:
+        classifier = foodClassifier()
+
+    (tes3list, levlist, ilist) = ([], [], [])
+    loadorder = {}
+    for (n, parsed) in enumerate(plugins):
+        tes3list += parsed['tes3']
+        levlist += parsed['levc']
+        levlist += parsed['levi']
+        ilist += parsed['ingr']
+        if parsed['ingr']:
+            loadorder[parsed['ingr'][0].file] = n
+
+    # first, look at the tes3 records so we can get a list
+    # of master files required by all our mods
+
+    masters = {}
+    for t in tes3list:
+        for m in t['masters']:
+            masters[m[0]] = m[1]
+
+    master_list = [ (k,v) for (k,v) in masters.items() ]
+
+    # look at the leveled lists -- we want to sort things
+    # as food, if they appear in a food leveled list. so,
+    # get a list of items that appear in lists of "food"
+
+    leveled = leveledIndex(levlist)
+    foodset = classifier.members(leveled)
+
+    # we need to uniquify the list -- mods may alter
+    # Vanilla ingredients by replacing them (and may not
+    # spell the id with the same case when they do)
+
+    (ingrs_by_id, overrides) = overrideIndex(ilist, loadorder)
+
+    # look for ingredients that
+    #   1- use the same models as each other
+    #   2- have identical effects
+    #
+    # stash all but one of those ingredients so we
+    # can maintain that consistency
+
+    if numpy is not None:
+        dupelists = findDupesColumnar(list(ingrs_by_id.values()))
+    else:
+        dupelists = findDupes(ingrs_by_id.values())
+
+    dupe_ingrs = {}
+    for dupelist in dupelists:
+        # select one id to map the dupes
+        anchor_id = dupelist[0].id
+        # stash the dupes
+        dupe_ingrs[anchor_id] = dupelist[1:]
+        # remove the dupes from the main set
+        for dupe in dupelist[1:]:
+            del ingrs_by_id[normalizeId(dupe.id)]
 
     # now sort the ingredients into food and non-food
 
@@ -537,52 +2302,689 @@ def main(cfg, outmoddir, outmod):
     nonfoods_by_id = {}
 
     for ingr in ingrs_by_id.values():
-        if ingr['id'] in foodset or 'food' in ingr['id'] \
-           or 'Food' in ingr['id']:
-            foods_by_id[ingr['id']] = ingr
+        if normalizeId(ingr.id) in foodset or classifier.matchesId(ingr.id):
+            foods_by_id[ingr.id] = ingr
         else:
-            nonfoods_by_id[ingr['id']] = ingr
-
-    # now we build a new dict with shuffled ingredient effects
+            nonfoods_by_id[ingr.id] = ingr
+
+    collected = {}
+    collected['masters'] = master_list
+    collected['foods'] = foods_by_id
+    collected['nonfoods'] = nonfoods_by_id
+    collected['dupes'] = dupe_ingrs
+    collected['overrides'] = overrides
+    collected['leveled'] = leveled
+    collected['plugins'] = list(loadorder)
+    # filled in by columnarPools, if the columnar shuffle runs
+    collected['columnar'] = {}
+    return collected
+
+def writeConflicts(overrides, out=None):
+    # the override report: every ingredient that more than
+    # one record defines, with its chain, the winner last.
+    # each plugin comes with where it is in the load order,
+    # and which of its ingredients the record is, from 1
+    out = out or sys.stdout
+    count = 0
+    for (key, chain) in overrides.items():
+        if len(chain) < 2:
+            continue
+        out.write("%s: %s\n" % (key, ' <- '.join('%s (#%d in load order, ingredient %d)'
+                                                  % (f, n + 1, pos + 1)
+                                                  for (f, n, pos) in chain)))
+        count += 1
+    out.write("%d of %d ingredients are defined more than once\n"
+              % (count, len(overrides)))
+
+def reportConflicts(cfg, out=None, cachedir=None, jobs=1, outmods=()):
+    # write the override report for a load order. plugins come
+    # through loadPlugins, so with a cache nothing gets re-read.
+    # outmods are the modules we write, which are left out (an
+    # enabled one would override every ingredient there is)
+    resolved = resolveConfig(cfg)
+    reportMissing(resolved['missing'], sys.stderr)
+
+    fp_mods = withoutOutputs(resolved['plugins'], outmods)
+    ilist = [ ingr for (f, parsed) in loadPlugins(fp_mods, cachedir, jobs)
+              for ingr in parsed['ingr'] ]
+    loadorder = { os.path.basename(f): n for (n, f) in enumerate(fp_mods) }
+    writeConflicts(overrideIndex(ilist, loadorder)[1], out)
+
+def shuffleCollected(collected, rng, algorithm='classic', maxshare=None):
+    # build a new dict with shuffled ingredient effects, using
+    # one of shuffleAlgorithms. the shuffle rewrites the
+    # ingredients it's given, so work on copies -- that way the
+    # same collected ingredients can be shuffled again (with
+    # another seed, say). the columnar shuffle makes its own
+
+    if usableAlgorithm(algorithm) == 'columnar':
+        # a numpy generator, seeded from ours, so the seed
+        # still decides everything
+        nprng = numpy.random.default_rng(rng.getrandbits(128))
+        (foodpool, nonfoodpool) = columnarPools(collected)
+        shuffled_ingredients = shuffle_ingredients_columnar(collected['foods'], nprng, foodpool)
+        shuffled_ingredients.update(shuffle_ingredients_columnar(collected['nonfoods'],
+                                                                 nprng, nonfoodpool))
+        return addDupes(collected, shuffled_ingredients)
+
+    foods = { k: v.copy() for (k, v) in collected['foods'].items() }
+    nonfoods = { k: v.copy() for (k, v) in collected['nonfoods'].items() }
+
+    if algorithm == 'constrained':
+        shuffled_ingredients = shuffle_ingredients_constrained(foods, rng, maxshare)
+        shuffled_ingredients.update(shuffle_ingredients_constrained(nonfoods, rng, maxshare))
+    else:
+        shuffled_ingredients = shuffle_ingredients(foods, rng)
+        shuffled_ingredients.update(shuffle_ingredients(nonfoods, rng))
 
-    shuffled_ingredients = shuffle_ingredients(foods_by_id)
-    shuffled_ingredients.update(shuffle_ingredients(nonfoods_by_id))
+    return addDupes(collected, shuffled_ingredients)
 
-    # it's time to re-add the duplicates
+def addDupes(collected, shuffled_ingredients):
+    # it's time to re-add the duplicates, with the same
+    # effects as their anchors
 
-    for (anchor_id, dupelist) in dupe_ingrs.items():
+    for (anchor_id, dupelist) in collected['dupes'].items():
         for dupe in dupelist:
-            dupe['effects'] = shuffled_ingredients[anchor_id]['effects']
-            shuffled_ingredients[dupe['id']] = dupe
+            dupe = dupe.copy()
+            dupe.effects = shuffled_ingredients[anchor_id].effects
+            shuffled_ingredients[dupe.id] = dupe
+
+    return shuffled_ingredients
+
+def moduleDescription(ingredients, digest=None, plugins=None):
+    # the module description for the new merged mod is
+    # built out of the names of mods that had ingredients, in
+    # load order (given by plugins, the file names of all the
+    # mods in it), so it's the same from run to run, whatever
+    # the seed.
+    #
+    # digest, if given, is the inputHash for the module. it
+    # goes at the end, and the list of mods gets cut short if
+    # need be so that it always fits in the 256-byte HEDR
+
+    files = set(x.file for x in ingredients)
+    if plugins is None:
+        plugins = dict.fromkeys(x.file for x in ingredients)
+    names = [ f for f in plugins if f in files ]
+
+    desc = "Shuffled ingredients from: %s" % ', '.join(names)
+    if digest is None:
+        return desc
+
+    tag = ' [inputs %s]' % digest
+    return desc[:255 - len(tag)] + tag
+
+def inputHash(collected, seed, algorithm='classic', maxshare=None):
+    # a hash of everything that decides what a module will
+    # contain: the collected ingredients (in order, since that
+    # matters to the shuffle), the masters, the seed, and the
+    # shuffle settings and version. two runs with the same
+    # hash write the same module
+    h = hashlib.sha1()
+    h.update(repr((shuffleVersion, seed, algorithm, maxshare,
+                   collected['masters'])).encode())
+
+    def ingredientKey(ingr):
+        return repr(tuple(getattr(ingr, attr)
+                          for attr in Ingredient.__slots__)).encode()
+
+    for kind in ('foods', 'nonfoods'):
+        h.update(kind.encode())
+        for ingr in collected[kind].values():
+            h.update(ingredientKey(ingr))
+    h.update(b'dupes')
+    for (anchor_id, dupelist) in collected['dupes'].items():
+        h.update(anchor_id.encode())
+        for dupe in dupelist:
+            h.update(ingredientKey(dupe))
+
+    return h.hexdigest()
+
+inputHashPattern = re.compile(r'\[inputs ([0-9a-f]{40})\]$')
+
+def recordedHash(outmod):
+    # the inputHash an existing module was written with, from
+    # its description, or None if there's no module there (or
+    # it's not one of ours, or it's from before we did this)
+    try:
+        for rec in mapRecords(outmod, ('TES3',)):
+            m = inputHashPattern.search(parseTES3(rec).get('desc', ''))
+            return m.group(1) if m else None
+    except Exception:
+        # missing, truncated, or otherwise broken -- any of
+        # those just means it gets written again
+        pass
+    return None
+
+def newSeed():
+    return SystemRandom().randrange(1 << 32)
+
+def manifestFilename(outmod):
+    return outmod + '.manifest'
+
+def writeManifest(outmod, seed, shuffle, plugins):
+    manifest = {}
+    manifest['version'] = manifestVersion
+    manifest['seed'] = seed
+    manifest['shuffle'] = shuffle
+    manifest['plugins'] = [ storedPlugin(p) for p in plugins ]
+    writePickle(manifestFilename(outmod), manifest)
+
+def readManifest(outmod):
+    # the manifest from the last run for outmod, or None
+    manifest = readPickle(manifestFilename(outmod), manifestVersion)
+    if manifest is not None:
+        manifest['plugins'] = [ restoredPlugin(p) for p in manifest['plugins'] ]
+    return manifest
+
+def refreshPlugins(fp_mods, manifest, cachedir=None, jobs=1, prefetch=0,
+                   stream=False, progress=False):
+    # returns the parsed data for every plugin in fp_mods, in
+    # load order, and whether anything changed since the
+    # manifest was written. plugins the manifest has, and that
+    # haven't changed, are taken from it; only plugins that
+    # are new or modified get loaded (and so maybe re-parsed).
+    #
+    # with progress set, loading shows a Progress line instead
+    # of a line per plugin
+
+    known = {}
+    if manifest is not None:
+        for parsed in manifest['plugins']:
+            known[parsed['source']['path']] = parsed
+
+    plugins = [ None ] * len(fp_mods)
+    toload = []
+    for (i, f) in enumerate(fp_mods):
+        parsed = known.get(os.path.abspath(f))
+        if parsed is not None and identityMatches(parsed['source'], f):
+            parsed['stats'] = newPluginStats('manifest')
+            plugins[i] = parsed
+        else:
+            toload.append(i)
+
+    counts = None
+    if progress and toload:
+        counts = [ headerRecords(fp_mods[i]) for i in toload ]
+        meter = Progress(counts)
+
+    for (n, (i, (f, parsed))) in enumerate(zip(toload,
+                                               loadPlugins([ fp_mods[i] for i in toload ],
+                                                           cachedir, jobs, prefetch,
+                                                           stream))):
+        if counts is not None:
+            meter.advance(f, counts[n])
+        else:
+            print("Parsed '%s' for relevant records" % f)
+        plugins[i] = parsed
+
+    changed = manifest is None or len(toload) > 0 or \
+        [ p['source']['path'] for p in manifest['plugins'] ] != \
+        [ p['source']['path'] for p in plugins ]
+
+    return (plugins, changed)
 
-    # now turn those ingredients back into INGR records
+
+# The same pipeline as main, as a library. each stage takes
+# what the one before it returned, hands back one of the
+# classes below, and prints nothing. a long-running program
+# can hold on to the scanned plugins (or the index) and
+# shuffle from them as often as it likes:
+#
+#   order = resolveLoadOrder(cfg)
+#   plugins = scanPlugins(order.plugins)
+#   index = buildIndex(plugins)
+#   result = shuffleIndex(index, seed=42)
+#   addon = packAddon(result)          # bytes, or
+#   packAddon(result, out=f)           # into a binary stream
+
+class LoadOrder(object):
+    # the load order an openmw.cfg describes (see resolveConfig)
+
+    __slots__ = ('configs', 'data', 'content', 'plugins', 'missing')
+
+    def __init__(self, resolved):
+        for attr in self.__slots__:
+            setattr(self, attr, resolved[attr])
+
+    def __repr__(self):
+        return 'LoadOrder(%d plugins, %d missing)' % (len(self.plugins),
+                                                     len(self.missing))
+
+class Plugin(object):
+    # one scanned plugin. parsed is what parsePlugin returned
+    # for it (and what gets cached), the rest is shorthand
+
+    __slots__ = ('name', 'parsed')
+
+    def __init__(self, name, parsed):
+        self.name = name
+        self.parsed = parsed
+
+    @property
+    def ingredients(self):
+        return self.parsed['ingr']
+
+    @property
+    def masters(self):
+        return [ m for t in self.parsed['tes3'] for m in t['masters'] ]
+
+    @property
+    def source(self):
+        return self.parsed['source']
+
+    @property
+    def stats(self):
+        return self.parsed['stats']
+
+    def __repr__(self):
+        return 'Plugin(%r, %d ingredients)' % (self.name, len(self.ingredients))
+
+class IngredientIndex(object):
+    # everything the shuffle needs, deduplicated and sorted
+    # into food and non-food (see collectIngredients)
+
+    __slots__ = ('masters', 'foods', 'nonfoods', 'dupes', 'overrides',
+                 'leveled', 'plugins', 'columnar')
+
+    def __init__(self, collected):
+        for attr in self.__slots__:
+            setattr(self, attr, collected[attr])
+
+    def collected(self):
+        return { attr: getattr(self, attr) for attr in self.__slots__ }
+
+    def __len__(self):
+        return len(self.foods) + len(self.nonfoods) + \
+            sum(len(d) for d in self.dupes.values())
+
+    def __repr__(self):
+        return 'IngredientIndex(%d ingredients)' % len(self)
+
+class ShuffleResult(object):
+    # one shuffle of an index: the shuffled ingredients, in
+    # the order they'll be written, and what's needed to
+    # write them out (or make them again)
+
+    __slots__ = ('seed', 'algorithm', 'maxshare', 'masters',
+                 'ingredients', 'digest', 'description')
+
+    def __init__(self, seed, algorithm, maxshare, masters, ingredients,
+                 digest=None, plugins=None):
+        self.seed = seed
+        self.algorithm = algorithm
+        self.maxshare = maxshare
+        self.masters = masters
+        self.ingredients = ingredients
+        self.digest = digest
+        self.description = moduleDescription(ingredients, digest, plugins)
+
+    def __repr__(self):
+        return 'ShuffleResult(seed=%d, %d ingredients)' % (self.seed,
+                                                          len(self.ingredients))
+
+def resolveLoadOrder(cfg):
+    return LoadOrder(resolveConfig(cfg))
+
+def scanPlugins(sources, cachedir=None, jobs=1, prefetch=0, stream=False):
+    # scan plugins, in load order. each source is either a
+    # path, or a (name, data) pair for a plugin that's already
+    # in memory -- any bytes-like data will do. paths go through
+    # loadPlugins (and so the cache, jobs, prefetch and stream); data
+    # is parsed where it is, and never cached
+    plugins = [ None ] * len(sources)
+    paths = []
+    for (i, src) in enumerate(sources):
+        if isinstance(src, tuple):
+            (name, data) = src
+            plugins[i] = Plugin(name, parsePlugin(name, data, inmemory=True))
+        else:
+            paths.append(i)
+
+    for (i, (f, parsed)) in zip(paths, loadPlugins([ sources[i] for i in paths ],
+                                                   cachedir, jobs, prefetch,
+                                                   stream)):
+        plugins[i] = Plugin(os.path.basename(f), parsed)
+
+    return plugins
+
+def buildIndex(plugins, classifier=None):
+    return IngredientIndex(collectIngredients([ p.parsed for p in plugins ],
+                                              classifier))
+
+def shuffleIndex(index, seed=None, algorithm='classic', maxshare=None):
+    # the index isn't changed, so it can be shuffled again
+    if algorithm not in shuffleAlgorithms:
+        raise ValueError("unknown shuffle algorithm '%s'" % algorithm)
+    algorithm = usableAlgorithm(algorithm)
+    if seed is None:
+        seed = newSeed()
+    collected = index.collected()
+    shuffled = shuffleCollected(collected, Random(seed), algorithm, maxshare)
+    return ShuffleResult(seed, algorithm, maxshare, index.masters,
+                         list(shuffled.values()),
+                         inputHash(collected, seed, algorithm, maxshare),
+                         index.plugins)
+
+def packAddon(result, out=None):
+    # the module for a shuffle, as bytes, or written to out (a
+    # binary file object) if given
+    if out is not None:
+        writeRecords(out, result.description, result.masters,
+                     result.ingredients)
+        return None
+
+    buf = io.BytesIO()
+    writeRecords(buf, result.description, result.masters, result.ingredients)
+    return buf.getvalue()
+
+
+def main(cfg, outmoddir, outmod, cachedir=None, jobs=1, seed=None,
+         incremental=False, timings=None, prefetch=0,
+         algorithm='classic', maxshare=None, stream=False, classifier=None,
+         progress=False):
+    # timings, if given, is a Timings that gets filled in as
+    # we go, for the caller to report on
+    if timings is None:
+        timings = Timings()
+
+    with timings.phase('config'):
+        fp_mods = withoutOutputs(readCfg(cfg), [ outmod ])
+
+    # in incremental mode, we start from the manifest of the
+    # last run, which also supplies the seed if we weren't
+    # given one
+
+    manifest_file = manifestFilename(outmod)
+    manifest = None
+    if incremental:
+        with timings.phase('manifest'):
+            manifest = readManifest(outmod)
+        if manifest is None:
+            print("No usable manifest at '%s', doing a full run" % manifest_file)
+        elif seed is None:
+            seed = manifest['seed']
+
+    if seed is None:
+        seed = newSeed()
+
+    # grab the parsed records from the files (or from the
+    # cache or manifest, if they haven't changed). they
+    # come back in load order, so later mods still win
+
+    if manifest is not None:
+        mtimes = [ p['source']['mtime'] for p in manifest['plugins'] ]
+
+    with timings.phase('load'):
+        (plugins, changed) = refreshPlugins(fp_mods, manifest, cachedir,
+                                            jobs, prefetch, stream, progress)
+
+    for (f, parsed) in zip(fp_mods, plugins):
+        timings.addPlugin(f, parsed['stats'])
+
+    if classifier is None:
+        classifier = foodClassifier()
+
+    if manifest is not None and not changed and manifest['seed'] == seed \
+       and manifest.get('shuffle') == (algorithm, maxshare, classifier.settings()) \
+       and os.path.exists(outmod):
+        # plugins that were only touched have had their new
+        # mtimes noted (see identityMatches). save those, or
+        # they'd be hashed all over again on every later run
+        if [ p['source']['mtime'] for p in manifest['plugins'] ] != mtimes:
+            writeManifest(outmod, seed, manifest['shuffle'], plugins)
+        print("Nothing has changed since the last run. '%s' is up to date." % outmod)
+        return
+
+    written = regenerate(plugins, seed, outmoddir, outmod, timings,
+                         algorithm, maxshare, classifier)
+
+    print("Used seed %d" % seed)
+
+    if written:
+        printInstructions(outmod)
+
+def regenerate(plugins, seed, outmoddir, outmod, timings,
+               algorithm='classic', maxshare=None, classifier=None):
+    # the back half of main: collect, shuffle and write out
+    # the parsed plugins, and the manifest that goes with them.
+    # returns whether the module was (re)written
     #
-    # along the way, build up the module
-    # description for the new merged mod, out
-    # of the names of mods that had ingredients
+    # if the module that's already there was made from exactly
+    # this (the same ingredients, seed and shuffle), there's no
+    # need to shuffle or write it again -- and leaving it alone
+    # means its timestamp doesn't change either
 
-    ilist_bin = b''
-    plugins = set()
-    for x in shuffled_ingredients.values():
-        ilist_bin += packINGR(x)
-        plugins.add(x['file'])
+    with timings.phase('collect'):
+        collected = collectIngredients(plugins, classifier)
+        digest = inputHash(collected, seed, algorithm, maxshare)
 
-    moddesc = "Shuffled ingredients from: %s" % ', '.join(plugins)
+    uptodate = recordedHash(outmod) == digest
 
-    # finally, build the binary form of the
-    # TES3 record, and write the whole thing
-    # out to disk
+    if uptodate:
+        print("The ingredients haven't changed. '%s' is up to date." % outmod)
+    else:
+        with timings.phase('shuffle'):
+            shuffled_ingredients = shuffleCollected(collected, Random(seed),
+                                                    algorithm, maxshare)
+            ingredients = list(shuffled_ingredients.values())
+
+    # finally, turn those ingredients back into INGR
+    # records, and write them out to disk behind the
+    # TES3 record
+
+    with timings.phase('write'):
+        if not uptodate:
+            if not os.path.exists(outmoddir):
+                p = Path(outmoddir)
+                p.mkdir(parents=True)
+
+            writeAddon(outmod, moduleDescription(ingredients, digest,
+                                                 collected['plugins']),
+                       collected['masters'], ingredients)
+
+        # and record what went into it, for --incremental
+
+        writeManifest(outmod, seed, (algorithm, maxshare,
+                                     (classifier or foodClassifier()).settings()),
+                      plugins)
+
+    return not uptodate
+
+def fileStamp(path):
+    # what --watch polls: (mtime, size), or None if it's gone
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def withoutOutputs(plugins, outmods):
+    # the load order, minus the modules we write. once one is
+    # enabled, it's in openmw.cfg like any other plugin -- and
+    # reading it back in would shuffle the last shuffle again,
+    # and change our input every time we write it
+    names = set(os.path.basename(m).lower() for m in outmods)
+    return [ f for f in plugins if os.path.basename(f).lower() not in names ]
+
+def watchStamps(order, outmod):
+    # the stamps of everything that can change the output:
+    # the config files, the plugins themselves, and the names
+    # in the data directories (so plugins that appear in or
+    # vanish from them get noticed). the output module, and
+    # the files written alongside it, don't count
+    own = os.path.basename(outmod).lower()
+    paths = order.configs + withoutOutputs(order.plugins, [ outmod ])
+    stamps = { path: fileStamp(path) for path in paths }
+    for d in order.data:
+        try:
+            names = os.listdir(d)
+        except OSError:
+            names = []
+        stamps[d] = sorted(n for n in names if not n.lower().startswith(own))
+    return stamps
+
+def mainWatch(cfg, outmoddir, outmod, cachedir=None, jobs=1, seed=None,
+              prefetch=0, algorithm='classic', maxshare=None, stream=False,
+              interval=1.0, settle=2.0, classifier=None):
+    # keep running, and regenerate the module whenever the
+    # config or any plugin in it changes. the parsed plugins
+    # are kept in memory between runs (in the same shape as a
+    # manifest), so after a change only the plugins that
+    # changed get re-parsed, everything else is reused.
+    #
+    # changes are noticed by polling mtimes and sizes every
+    # `interval` seconds. a burst of changes (a mod manager
+    # copying files in, say) is waited out: nothing happens
+    # until `settle` seconds pass with no further change.
+    #
+    # the seed stays the same for the whole session, so the
+    # module only changes when the mods do
+
+    manifest = readManifest(outmod)
+    if seed is None:
+        seed = manifest['seed'] if manifest is not None else newSeed()
+
+    print("Watching '%s' (seed %d). Press Ctrl-C to stop." % (cfg, seed))
+
+    first = True
+    try:
+        while True:
+            order = resolveLoadOrder(cfg)
+            stamps = watchStamps(order, outmod)
+            fp_mods = withoutOutputs(order.plugins, [ outmod ])
+
+            reportMissing(order.missing)
+
+            # a plugin that's still being written can fail to
+            # parse. that's not the end of the world: say so, and
+            # try again once it changes
+
+            timings = Timings()
+            try:
+                with timings.phase('load'):
+                    (plugins, changed) = refreshPlugins(fp_mods, manifest,
+                                                        cachedir, jobs, prefetch,
+                                                        stream)
+                if first or changed:
+                    if regenerate(plugins, seed, outmoddir, outmod, timings,
+                                  algorithm, maxshare, classifier):
+                        print("Wrote '%s' in %.2fs" % (outmod, sum(ph['wall']
+                                                                  for ph in timings.phases)))
+                manifest = { 'seed': seed, 'plugins': plugins }
+                first = False
+            except Exception as e:
+                print("Couldn't regenerate '%s' (%s), waiting for more changes" % (outmod, e))
+
+            # wait for something to change, and then for it to
+            # stop changing
+
+            while watchStamps(resolveLoadOrder(cfg), outmod) == stamps:
+                time.sleep(interval)
+
+            quiet = 0.0
+            while quiet < settle:
+                time.sleep(interval)
+                latest = watchStamps(resolveLoadOrder(cfg), outmod)
+                if latest != stamps:
+                    (stamps, quiet) = (latest, 0.0)
+                else:
+                    quiet += interval
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+
+def batchFilename(outmod, seed):
+    (stem, ext) = os.path.splitext(outmod)
+    return '%s - seed %d%s' % (stem, seed, ext)
+
+def shuffleAndWrite(collected, seed, outmod, algorithm='classic', maxshare=None):
+    # one output of a batch run. this is what the worker
+    # processes run, so it takes everything it needs. returns
+    # whether it wrote anything: a module already made from
+    # the same inputs is left alone (see inputHash)
+    digest = inputHash(collected, seed, algorithm, maxshare)
+    if recordedHash(outmod) == digest:
+        return False
+
+    ingredients = list(shuffleCollected(collected, Random(seed),
+                                        algorithm, maxshare).values())
+    writeAddon(outmod, moduleDescription(ingredients, digest,
+                                         collected['plugins']),
+               collected['masters'], ingredients)
+    return True
+
+# what the batch workers share: the collected ingredients and
+# the shuffle settings, handed over once per worker process
+# (by initBatchWorker) rather than once per seed
+batchShared = None
+
+# the parts of the collected ingredients a shuffle needs
+batchKeys = ('masters', 'foods', 'nonfoods', 'dupes', 'plugins', 'columnar')
+
+def initBatchWorker(collected, algorithm, maxshare):
+    global batchShared
+    batchShared = (collected, algorithm, maxshare)
+
+def batchWorker(seed, outmod):
+    (collected, algorithm, maxshare) = batchShared
+    return shuffleAndWrite(collected, seed, outmod, algorithm, maxshare)
+
+def mainBatch(cfg, outmoddir, outmod, seeds, cachedir=None, jobs=1,
+              timings=None, prefetch=0, algorithm='classic', maxshare=None,
+              stream=False, classifier=None, progress=False):
+    # like main, but write one module per seed. the plugins are
+    # read, deduplicated and sorted into food and non-food only
+    # once; then each seed gets its own shuffle, and its own
+    # module named after it. any one of them can be made again
+    # with main and the same seed.
+    #
+    # with more than one job, the shuffling and packing for the
+    # different seeds happens in a pool of worker processes
+    if timings is None:
+        timings = Timings()
+
+    outmods = [ batchFilename(outmod, seed) for seed in seeds ]
+
+    with timings.phase('config'):
+        fp_mods = withoutOutputs(readCfg(cfg), [ outmod ] + outmods)
+
+    with timings.phase('load'):
+        (plugins, changed) = refreshPlugins(fp_mods, None, cachedir,
+                                            jobs, prefetch, stream, progress)
+
+    for (f, parsed) in zip(fp_mods, plugins):
+        timings.addPlugin(f, parsed['stats'])
+
+    with timings.phase('collect'):
+        collected = collectIngredients(plugins, classifier)
+
+    with timings.phase('write'):
+        if not os.path.exists(outmoddir):
+            p = Path(outmoddir)
+            p.mkdir(parents=True)
+
+        if jobs > 1 and len(seeds) > 1:
+            # encode once here, rather than in every worker
+            if usableAlgorithm(algorithm) == 'columnar':
+                columnarPools(collected)
+            shared = { k: collected[k] for k in batchKeys }
+            with ProcessPoolExecutor(max_workers=jobs, initializer=initBatchWorker,
+                                     initargs=(shared, algorithm, maxshare)) as executor:
+                written = list(executor.map(batchWorker, seeds, outmods))
+        else:
+            written = [ shuffleAndWrite(collected, seed, om, algorithm, maxshare)
+                        for (seed, om) in zip(seeds, outmods) ]
 
-    if not os.path.exists(outmoddir):
-        p = Path(outmoddir)
-        p.mkdir(parents=True)
+    for (seed, om, w) in zip(seeds, outmods, written):
+        if w:
+            print("Wrote '%s' (seed %d)" % (om, seed))
+        else:
+            print("'%s' (seed %d) is up to date" % (om, seed))
 
-    with open(outmod, 'wb') as f:
-        f.write(packTES3(moddesc, len(shuffled_ingredients),
-                         master_list))
-        f.write(ilist_bin)
+    print("\nEach module is a complete shuffle on its own; enable only one at a time.")
 
-    # And give some hopefully-useful instructions
+def printInstructions(outmod):
+    # give some hopefully-useful instructions
 
     modShortName = os.path.basename(outmod)
     print("\n\n****************************************")
@@ -614,8 +3016,126 @@ if __name__ == '__main__':
                         action = 'store_true', required = False,
                         help = 'Instead of generating merged lists, dump all alchemy ingredients in the conf mods. Used for debugging')
 
+    parser.add_argument('--dumpformat', type = str, default = 'text',
+                        action = 'store', required = False, choices = ('text', 'jsonl', 'csv'),
+                        help = 'With --dumpalchs, the output format: "text" (the default), "jsonl" (one JSON object per line), or "csv".')
+
+    parser.add_argument('--dumpfile', type = str, default = None,
+                        action = 'store', required = False,
+                        help = 'With --dumpalchs, write to this file instead of stdout.')
+
+    parser.add_argument('--dumpplugin', type = str, default = None,
+                        action = 'store', required = False,
+                        help = 'With --dumpalchs, only dump plugins whose file names match this glob (e.g. "Tamriel*").')
+
+    parser.add_argument('--dumpid', type = str, default = None,
+                        action = 'store', required = False,
+                        help = 'With --dumpalchs, only dump ingredients whose IDs match this regular expression.')
+
+    parser.add_argument('--dumpeffect', type = int, default = None,
+                        action = 'append', required = False,
+                        help = 'With --dumpalchs, only dump ingredients with this effect id. Can be given more than once.')
+
+    parser.add_argument('--dumplimit', type = int, default = None,
+                        action = 'store', required = False,
+                        help = 'With --dumpalchs, stop after this many ingredients.')
+
+    parser.add_argument('--probe', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Instead of shuffling, quickly check the load order using only the headers of the plugins: plugins that can\'t be found, and masters that are missing, load too late, or have changed size. Exits with an error if anything is wrong.')
+
+    parser.add_argument('--progress', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Show progress, and an estimate of the time left, while loading plugins.')
+
+    parser.add_argument('--conflicts', type = str, default = None,
+                        action = 'store', required = False, nargs = '?', const = '-',
+                        help = 'Instead of shuffling, report every ingredient that more than one plugin (or record) defines, with the plugins that override it in load order. Written to this file if given, otherwise printed.')
+
+    parser.add_argument('--cachedir', type = str, default = None,
+                        action = 'store', required = False,
+                        help = 'Directory to cache parsed plugin data in. By default, attempts to use the platform cache directory.')
+
+    parser.add_argument('--nocache', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Don\'t read or write the parsed plugin cache.')
+
+    parser.add_argument('--clearcache', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Clear the parsed plugin cache before running, so every plugin gets re-parsed.')
+
+    parser.add_argument('-s', '--seed', type = int, default = None,
+                        action = 'store', required = False,
+                        help = 'Seed for the shuffle. The same seed and mods always give the same module. By default, a random seed is picked (and printed).')
+
+    parser.add_argument('-a', '--algorithm', type = str, default = 'classic',
+                        action = 'store', required = False, choices = shuffleAlgorithms,
+                        help = 'Shuffle algorithm. "classic" (the default) keeps effect proportions exactly. "constrained" keeps them roughly, but also makes sure no ingredient gets an effect twice, and that every effect is on at least two ingredients. "columnar" is "classic" done with numpy, which is quicker for very large sets of ingredients, but shuffles differently for the same seed; without numpy installed, it falls back to "classic".')
+
+    parser.add_argument('--maxshare', type = int, default = None,
+                        action = 'store', required = False,
+                        help = 'With the constrained algorithm, the most ingredients (of food, or of non-food) that can share one effect (at least 2). It gives way where keeping it would leave an ingredient with no effects.')
+
+    parser.add_argument('--foodpattern', type = str, default = None,
+                        action = 'append', required = False,
+                        help = 'Regular expression for what counts as food: ingredients in leveled lists (creature or item) whose names match, or whose own IDs match. Can be given more than once. By default, "[Ff]ood".')
+
+    parser.add_argument('--foodlist', type = str, default = None,
+                        action = 'append', required = False,
+                        help = 'Name of a leveled list (creature or item) whose ingredients count as food. Can be given more than once. Giving this or --foodpattern replaces the default.')
+
+    parser.add_argument('--seeds', type = str, default = None,
+                        action = 'store', required = False,
+                        help = 'Comma-separated list of seeds. Writes one module per seed (named after it), reading the mods only once.')
+
+    parser.add_argument('--count', type = int, default = None,
+                        action = 'store', required = False,
+                        help = 'Like --seeds, but write this many modules with randomly picked seeds.')
+
+    parser.add_argument('--incremental', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Start from the manifest of the last run with the same module name: only re-parse plugins that were added or changed, reuse its seed (unless --seed is given), and skip writing if nothing changed.')
+
+    parser.add_argument('--watch', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Keep running, and regenerate the module whenever openmw.cfg or any of the plugins in it change. Parsed plugins are kept in memory, so only changed plugins are re-parsed. Stop with Ctrl-C.')
+
+    parser.add_argument('--interval', type = float, default = 1.0,
+                        action = 'store', required = False,
+                        help = 'With --watch, how often to check for changes, in seconds. Defaults to 1.')
+
+    parser.add_argument('--settle', type = float, default = 2.0,
+                        action = 'store', required = False,
+                        help = 'With --watch, how long things have to stay unchanged before regenerating, in seconds, so a burst of changes only triggers one run. Defaults to 2.')
+
+    parser.add_argument('--prefetch', type = int, default = 0,
+                        action = 'store', required = False,
+                        help = 'Read plugins on a background thread while parsing, holding at most this many MB in memory. Helps on slow or network disks. Ignored with --jobs or --stream. By default, off.')
+
+    parser.add_argument('--stream', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Read plugins one record at a time through a small reusable buffer, parsing each record and dropping it straight away, so memory use follows the number of ingredients rather than the size of your mods. For low-memory machines.')
+
+    parser.add_argument('--timings', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Print a table of time spent in each phase, and of per-plugin counters (bytes read, records seen and kept, subrecords decoded).')
+
+    parser.add_argument('--timings-json', type = str, default = None,
+                        action = 'store', required = False, dest = 'timings_json',
+                        help = 'Write the same timings and counters as JSON to this file (or "-" for stdout, which sends everything else to stderr).')
+
+    parser.add_argument('--tracemalloc', default = False,
+                        action = 'store_true', required = False,
+                        help = 'Also track peak python memory per phase in the timings. This slows things down noticeably.')
+
+    parser.add_argument('-j', '--jobs', type = int, default = 1,
+                        action = 'store', required = False,
+                        help = 'Number of processes to parse plugins with. Use 0 for one per CPU. By default, plugins are parsed one at a time.')
+
     p = parser.parse_args()
 
+    if p.maxshare is not None and p.maxshare < 2:
+        parser.error("--maxshare must be at least 2, or no effect could be brewed")
 
     # determine the conf file to use
     confFile = ''
@@ -627,27 +3147,7 @@ if __name__ == '__main__':
             baseDir = os.path.expanduser(configPaths[pl])
             confFile = os.path.join(baseDir, configFilename)
         elif pl == 'win32':
-            # this is ugly. first, imports that only work properly on windows
-            from ctypes import *
-            import ctypes.wintypes
-
-            buf = create_unicode_buffer(ctypes.wintypes.MAX_PATH)
-
-            # opaque arguments. they are, roughly, for our purposes:
-            #   - an indicator of folder owner (0 == current user)
-            #   - an id for the type of folder (5 == 'My Documents')
-            #   - an indicator for user to call from (0 same as above)
-            #   - a bunch of flags for different things
-            #     (if you want, for example, to get the default path
-            #      instead of the actual path, or whatnot)
-            #     0 == current stuff
-            #   - the variable to hold the return value
-
-            windll.shell32.SHGetFolderPathW(0, 5, 0, 0, buf)
-
-            # pull out the return value and construct the rest
-            baseDir = os.path.join(buf.value, 'My Games', 'OpenMW')
-            confFile = os.path.join(baseDir, configFilename)
+            confFile = os.path.join(windowsUserDir(), configFilename)
         else:
             print("Sorry, I don't recognize the platform '%s'. You can try specifying the conf file using the '-c' flag." % p)
             sys.exit(1)
@@ -660,18 +3160,7 @@ if __name__ == '__main__':
         if pl in configPaths:
             baseModDir = os.path.expanduser(modPaths[pl])
         elif pl == 'win32':
-            # this is ugly in exactly the same ways as above.
-            # see there for more information
-
-            from ctypes import *
-            import ctypes.wintypes
-
-            buf = create_unicode_buffer(ctypes.wintypes.MAX_PATH)
-
-            windll.shell32.SHGetFolderPathW(0, 5, 0, 0, buf)
-
-            baseDir = os.path.join(buf.value, 'My Games', 'OpenMW')
-            baseModDir = os.path.join(baseDir, 'data')
+            baseModDir = os.path.join(windowsUserDir(), 'data')
         else:
             print("Sorry, I don't recognize the platform '%s'. You can try specifying the conf file using the '-c' flag." % p)
             sys.exit(1)
@@ -689,10 +3178,103 @@ if __name__ == '__main__':
 
     modFullPath = os.path.join(baseModDir, modName)
 
+    # and the cache directory. if we can't figure one out,
+    # we just run without a cache
+    cacheDir = None
+    if p.cachedir:
+        cacheDir = p.cachedir
+    elif not p.nocache:
+        pl = sys.platform
+        if pl in cachePaths:
+            cacheDir = os.path.expanduser(cachePaths[pl])
+        elif pl == 'win32' and 'LOCALAPPDATA' in os.environ:
+            cacheDir = os.path.join(os.environ['LOCALAPPDATA'],
+                                    'omw_shuffle_ingredients', 'cache')
+
+    if p.clearcache and cacheDir:
+        clearCache(cacheDir)
+        print("Cleared the cache in '%s'" % cacheDir)
+
+    if p.nocache:
+        cacheDir = None
+
+    jobs = p.jobs
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+
+    seeds = None
+    if p.seeds:
+        seeds = [ int(x) for x in p.seeds.split(',') if x.strip() ]
+    elif p.count:
+        seeds = [ newSeed() for i in range(p.count) ]
+
+    if usableAlgorithm(p.algorithm) != p.algorithm:
+        print("numpy isn't installed, so using the '%s' algorithm instead of '%s'"
+              % (usableAlgorithm(p.algorithm), p.algorithm))
+        p.algorithm = usableAlgorithm(p.algorithm)
+
+    try:
+        classifier = foodClassifier(p.foodpattern, p.foodlist)
+    except re.error as e:
+        print("Bad --foodpattern: %s" % e)
+        sys.exit(1)
+
+    if p.dumpid:
+        try:
+            re.compile(p.dumpid)
+        except re.error as e:
+            print("Bad --dumpid: %s" % e)
+            sys.exit(1)
+
     if p.dumpalchs:
-        dumpalchs(confFile)
+        dumpArgs = dict(fmt=p.dumpformat, plugins=p.dumpplugin,
+                        idpattern=p.dumpid, effects=p.dumpeffect,
+                        limit=p.dumplimit)
+        if p.dumpfile:
+            with open(p.dumpfile, 'w', newline='') as f:
+                dumpalchs(confFile, out=f, **dumpArgs)
+        else:
+            dumpalchs(confFile, **dumpArgs)
+    elif p.probe:
+        start = time.perf_counter()
+        probe = probeLoadOrder(confFile)
+        if not printProbe(probe, time.perf_counter() - start):
+            sys.exit(1)
+    elif p.conflicts:
+        if p.conflicts == '-':
+            reportConflicts(confFile, cachedir=cacheDir, jobs=jobs,
+                            outmods=[ modFullPath ])
+        else:
+            with open(p.conflicts, 'w') as f:
+                reportConflicts(confFile, f, cacheDir, jobs, [ modFullPath ])
+    elif p.watch:
+        mainWatch(confFile, baseModDir, modFullPath, cacheDir, jobs,
+                  seed=p.seed, prefetch=p.prefetch << 20,
+                  algorithm=p.algorithm, maxshare=p.maxshare, stream=p.stream,
+                  interval=p.interval, settle=p.settle, classifier=classifier)
     else:
-        main(confFile, baseModDir, modFullPath)
+        # with the JSON on stdout, everything meant for people goes to
+        # stderr, so the JSON can be piped as-is
+        human = sys.stderr if p.timings_json == '-' else sys.stdout
+        timings = Timings(trace_memory=p.tracemalloc)
+
+        with redirect_stdout(human):
+            if seeds:
+                mainBatch(confFile, baseModDir, modFullPath, seeds, cacheDir, jobs,
+                          timings=timings, prefetch=p.prefetch << 20,
+                          algorithm=p.algorithm, maxshare=p.maxshare, stream=p.stream,
+                          classifier=classifier, progress=p.progress)
+            else:
+                main(confFile, baseModDir, modFullPath, cacheDir, jobs,
+                     seed=p.seed, incremental=p.incremental, timings=timings,
+                     prefetch=p.prefetch << 20, algorithm=p.algorithm,
+                     maxshare=p.maxshare, stream=p.stream, classifier=classifier,
+                     progress=p.progress)
+
+            if p.timings:
+                timings.printTable()
+        if p.timings_json:
+            timings.dumpJSON(p.timings_json)
 
 
 